@@ -0,0 +1,232 @@
+"""Benchmark of the bot handling users' journeys against fake APIs.
+
+Moltin, Yandex geocoder and Telegram are replaced with local fake servers
+and Redis with fakeredis unless --redis-url is given. Every simulated
+user goes from /start to delivery through the real handlers, the time of
+every update is measured.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from typing import Dict, List, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from environs import Env
+from telegram import Update
+from telegram.ext import Dispatcher, Updater
+from telegram.utils.request import Request
+
+from fake_moltin import CENTER, start_fake_moltin_api
+from fake_telegram import make_callback_update, make_text_update, \
+    start_fake_bot_api
+from metrics_tools import TimedBot, TimedRedis
+from moltin_tools import MoltinSession
+from redis_tools import ChatStore
+from tg_bot import add_handlers, make_bot_data
+
+BENCHMARK_TOKEN = '123456:benchmark'
+
+
+def start_fake_geocoder(port: int = 0,
+                        latency: float = 0) -> ThreadingHTTPServer:
+    """Serve Yandex geocoder which finds any address near city center"""
+
+    class RequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(latency)
+            address = parse_qs(urlparse(self.path).query)['geocode'][0]
+            digest = hashlib.md5(address.encode('utf-8')).digest()
+            lat = CENTER[0] + (digest[0] - 128) / 128 * 0.03
+            lon = CENTER[1] + (digest[1] - 128) / 128 * 0.03
+            content = json.dumps({'response': {'GeoObjectCollection': {
+                'featureMember': [
+                    {'GeoObject': {'Point': {'pos': f'{lon} {lat}'}}},
+                ],
+            }}}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('0.0.0.0', port), RequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def make_redis(redis_url: str = None) -> TimedRedis:
+    if redis_url:
+        return TimedRedis.from_url(redis_url)
+    try:
+        import fakeredis
+    except ImportError:
+        raise SystemExit('Install fakeredis or pass --redis-url')
+    return TimedRedis(connection_pool=fakeredis.FakeRedis().connection_pool)
+
+
+def make_journey(chat_id: int, product_id: str,
+                 update_ids: count) -> List[Tuple[str, dict]]:
+    """Return steps of user who orders a pizza with delivery"""
+    return [
+        ('start', make_text_update(next(update_ids), chat_id, '/start')),
+        ('product', make_callback_update(next(update_ids), chat_id,
+                                         product_id)),
+        ('add', make_callback_update(next(update_ids), chat_id,
+                                     f'1,{product_id}')),
+        ('cart', make_callback_update(next(update_ids), chat_id, 'cart')),
+        ('address', make_callback_update(next(update_ids), chat_id,
+                                         'address')),
+        ('geocode', make_text_update(next(update_ids), chat_id,
+                                     f'Москва, Тверская улица, {chat_id}')),
+        ('delivery', make_callback_update(next(update_ids), chat_id,
+                                          'delivery')),
+    ]
+
+
+def run_journey(dispatcher: Dispatcher,
+                journey: List[Tuple[str, dict]]) -> List[Tuple[str, float]]:
+    """Handle journey updates one by one and return their durations"""
+    durations = []
+    for step, update in journey:
+        started_at = time.perf_counter()
+        dispatcher.process_update(Update.de_json(update, dispatcher.bot))
+        durations.append((step, time.perf_counter() - started_at))
+    return durations
+
+
+def get_percentile(sorted_values: List[float], percent: float) -> float:
+    index = min(len(sorted_values) - 1,
+                int(len(sorted_values) * percent / 100))
+    return sorted_values[index]
+
+
+def summarize(durations: List[float]) -> Dict[str, float]:
+    durations = sorted(durations)
+    return {
+        'count': len(durations),
+        'p50_ms': round(get_percentile(durations, 50) * 1000, 2),
+        'p95_ms': round(get_percentile(durations, 95) * 1000, 2),
+        'p99_ms': round(get_percentile(durations, 99) * 1000, 2),
+    }
+
+
+def get_commit() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--products', type=int, default=20)
+    parser.add_argument('--pizzerias', type=int, default=30)
+    parser.add_argument('--moltin-latency', type=float, default=0.02,
+                        help='seconds fake Moltin takes to answer')
+    parser.add_argument('--geocoder-latency', type=float, default=0.05,
+                        help='seconds fake geocoder takes to answer')
+    parser.add_argument('--moltin-rate-limit', type=float, default=1000)
+    parser.add_argument('--geocoder-rate-limit', type=float, default=10)
+    parser.add_argument('--redis-url',
+                        help='e.g. redis://localhost:6379/15, it should be '
+                             'a database for benchmarks only')
+    parser.add_argument('--json', help='file to write results to')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    moltin_server, moltin_api = start_fake_moltin_api(
+        products=args.products, pizzerias=args.pizzerias,
+        latency=args.moltin_latency)
+    geocoder_server = start_fake_geocoder(latency=args.geocoder_latency)
+    bot_api_server, bot_api = start_fake_bot_api(0)
+    os.environ['YANDEX_GEOCODER_URL'] = \
+        f'http://localhost:{geocoder_server.server_port}/1.x'
+    os.environ['YANDEX_RATE_LIMIT'] = str(args.geocoder_rate_limit)
+
+    redis_database = make_redis(args.redis_url)
+    moltin_client = MoltinSession(
+        'benchmark', 'benchmark',
+        base_url=f'http://localhost:{moltin_server.server_port}',
+        pool_size=args.concurrency * 2,
+        rate_limit=args.moltin_rate_limit
+    )
+    bot = TimedBot(
+        BENCHMARK_TOKEN,
+        base_url=f'http://localhost:{bot_api_server.server_port}/bot',
+        request=Request(con_pool_size=args.concurrency + 4))
+    updater = Updater(bot=bot, workers=1)
+    dispatcher = updater.dispatcher
+    dispatcher.bot_data.update(
+        make_bot_data(Env(), redis_database, moltin_client))
+    chat_store = ChatStore(redis_database)
+    add_handlers(dispatcher, chat_store, 'benchmark', moltin_client,
+                 'benchmark', admin_chat_id=0, run_async=False)
+
+    # Chat ids differ between runs, so a real Redis can be reused
+    first_chat_id = int(time.time()) % 100000 * 10000
+    update_ids = count(1)
+    journeys = [
+        make_journey(chat_id, f'product-{chat_id % args.products}',
+                     update_ids)
+        for chat_id in range(first_chat_id, first_chat_id + args.users + 1)]
+    # The first user loads catalog and addresses and is not measured
+    run_journey(dispatcher, journeys.pop(0))
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(
+            lambda journey: run_journey(dispatcher, journey), journeys))
+    elapsed = time.perf_counter() - started_at
+
+    durations = [duration for journey in results for duration in journey]
+    steps = {step: summarize([duration for duration_step, duration
+                              in durations if duration_step == step])
+             for step, _ in journeys[0]}
+    completed = sum(
+        chat_store.load(first_chat_id + number)[0] == 'START'
+        for number in range(1, args.users + 1))
+    report = {
+        'commit': get_commit(),
+        'params': vars(args),
+        'updates_per_second': round(len(durations) / elapsed, 1),
+        'completed_journeys': completed,
+        'all': summarize([duration for _, duration in durations]),
+        'steps': steps,
+        'moltin_requests': moltin_api.requests,
+        'telegram_requests': sum(len(methods) for methods
+                                 in bot_api.requests.values()),
+    }
+
+    print(f'commit {report["commit"]}, {args.users} users, '
+          f'concurrency {args.concurrency}')
+    print(f'{"step":<10}{"count":>8}{"p50 ms":>10}{"p95 ms":>10}'
+          f'{"p99 ms":>10}')
+    for step, summary in [*steps.items(), ('all', report['all'])]:
+        print(f'{step:<10}{summary["count"]:>8}{summary["p50_ms"]:>10}'
+              f'{summary["p95_ms"]:>10}{summary["p99_ms"]:>10}')
+    print(f'updates/sec {report["updates_per_second"]}, '
+          f'completed journeys {completed}/{args.users}, '
+          f'Moltin requests {report["moltin_requests"]}')
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,326 @@
+import json
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import asdict
+from typing import Any, Hashable, List, Optional, Tuple
+
+import redis
+from dacite import Config, from_dict
+from requests.exceptions import RequestException
+
+from geo_tools import GEOCODER_URL, AddressIndex, fetch_coordinates
+from moltin_tools import MoltinSession, Product, get_all_products, \
+    get_product_by_id, get_product_image_by_id, get_all_address_entries
+from resilience_tools import CircuitBreaker, RateLimiter
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    """Thread safe LRU cache with bounded size and TTL of entries"""
+
+    def __init__(self, maxsize: int = 256, ttl: int = 3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Return cached value or None if it is missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if time.monotonic() >= expires_at:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+class CatalogCache:
+    """Catalog of Moltin products cached in process with TTL.
+
+    If redis_db is passed the catalog is shared between bot workers,
+    so only one of them fetches it from Moltin per TTL. While Moltin is
+    unavailable the last fetched catalog is served.
+    """
+
+    def __init__(self, moltin_client: MoltinSession, ttl: int = 300,
+                 redis_db: redis.client.Redis = None,
+                 redis_key: str = 'catalog:products',
+                 stale_retry_interval: int = 30):
+        self.moltin_client = moltin_client
+        self.ttl = ttl
+        self.stale_retry_interval = stale_retry_interval
+        self.redis_db = redis_db
+        self.redis_key = redis_key
+        # Version and products are replaced together, so they always match
+        self._catalog = (0, None)
+        self._expires_at = 0
+        self._lock = threading.Lock()
+
+    def get_products(self) -> List[Product]:
+        """Return cached products, fetch them if cache has expired"""
+        return self.get_versioned_products()[1]
+
+    def get_versioned_products(self) -> Tuple[int, List[Product]]:
+        """Return catalog version and its products.
+
+        The version changes whenever fetched products differ from cached.
+        """
+        catalog = self._catalog
+        if self._is_fresh(catalog):
+            return catalog
+        with self._lock:
+            catalog = self._catalog
+            if self._is_fresh(catalog):
+                return catalog
+            version, cached_products = catalog
+            products = self._load_shared()
+            if products is None:
+                try:
+                    products = get_all_products(self.moltin_client)
+                except RequestException as error:
+                    if cached_products is None:
+                        raise
+                    # Stale menu is better than none while Moltin is down
+                    logger.warning(f'Stale catalog is used: {error}')
+                    self._expires_at = time.monotonic() + \
+                        min(self.ttl, self.stale_retry_interval)
+                    return catalog
+                self._store_shared(products)
+            if products != cached_products:
+                version += 1
+            self._catalog = (version, products)
+            self._expires_at = time.monotonic() + self.ttl
+            return self._catalog
+
+    def invalidate(self) -> None:
+        """Drop cached catalog, next get_products fetches it again"""
+        with self._lock:
+            self._expires_at = 0
+            if self.redis_db is not None:
+                self.redis_db.delete(self.redis_key)
+
+    def _is_fresh(self, catalog: Tuple[int, List[Product]]) -> bool:
+        return catalog[1] is not None and \
+            time.monotonic() < self._expires_at
+
+    def _load_shared(self) -> Optional[List[Product]]:
+        if self.redis_db is None:
+            return None
+        products = self.redis_db.get(self.redis_key)
+        if products is None:
+            return None
+        return [from_dict(data_class=Product, data=product,
+                          config=Config(check_types=False))
+                for product in json.loads(products)]
+
+    def _store_shared(self, products: List[Product]) -> None:
+        if self.redis_db is None:
+            return
+        self.redis_db.set(
+            self.redis_key,
+            json.dumps([asdict(product) for product in products]),
+            ex=self.ttl)
+
+
+class ProductCache:
+    """Product cards and their image hrefs cached by product id"""
+
+    def __init__(self, moltin_client: MoltinSession,
+                 catalog_cache: CatalogCache,
+                 maxsize: int = 256, ttl: int = 3600):
+        self.moltin_client = moltin_client
+        self.catalog_cache = catalog_cache
+        self.products = LRUCache(maxsize, ttl)
+        self.image_urls = LRUCache(maxsize, ttl)
+
+    def get_product(self, product_id: str) -> Product:
+        """Return cached product, fetch it from Moltin on miss.
+
+        If Moltin is unavailable the product from catalog is returned.
+        """
+        product = self.products.get(product_id)
+        if product is None:
+            try:
+                product = get_product_by_id(product_id, self.moltin_client)
+            except RequestException:
+                product = self._find_in_catalog(product_id)
+                if product is None:
+                    raise
+                return product
+            self.products.set(product_id, product)
+        return product
+
+    def _find_in_catalog(self, product_id: str) -> Optional[Product]:
+        try:
+            catalog_products = self.catalog_cache.get_products()
+        except RequestException:
+            return None
+        return next((product for product in catalog_products
+                     if product.id == product_id), None)
+
+    def get_image_url(self, product_file_id: str) -> str:
+        """Return cached image href, fetch it from Moltin on miss"""
+        image_url = self.image_urls.get(product_file_id)
+        if image_url is None:
+            image_url = get_product_image_by_id(product_file_id,
+                                                self.moltin_client)
+            self.image_urls.set(product_file_id, image_url)
+        return image_url
+
+    def invalidate(self) -> None:
+        """Drop cached products and image hrefs"""
+        self.products.clear()
+        self.image_urls.clear()
+
+    def refresh(self) -> None:
+        """Fetch every catalog product and its image into cache"""
+        for catalog_product in self.catalog_cache.get_products():
+            product = get_product_by_id(catalog_product.id,
+                                        self.moltin_client)
+            self.products.set(product.id, product)
+            if product.image_url:
+                self.image_urls.set(
+                    product.image_url,
+                    get_product_image_by_id(product.image_url,
+                                            self.moltin_client))
+
+
+class AddressRegistry:
+    """Pizza addresses of Moltin flow with their index kept in memory"""
+
+    def __init__(self, moltin_client: MoltinSession,
+                 flow_slug: str = 'pizza-address'):
+        self.moltin_client = moltin_client
+        self.flow_slug = flow_slug
+        self._index = None
+        self._lock = threading.Lock()
+
+    def get_index(self) -> AddressIndex:
+        """Return index of pizza addresses, load them on first call"""
+        index = self._index
+        if index is None:
+            index = self.refresh()
+        return index
+
+    def refresh(self) -> AddressIndex:
+        """Load pizza addresses from Moltin, rebuild index if they changed"""
+        addresses = get_all_address_entries(self.flow_slug,
+                                            self.moltin_client)
+        with self._lock:
+            if self._index is None or \
+                    self._index.pizza_addresses != addresses:
+                self._index = AddressIndex(addresses)
+            return self._index
+
+    def invalidate(self) -> None:
+        """Drop loaded addresses, next get_index loads them again"""
+        with self._lock:
+            self._index = None
+
+
+class PhotoCache:
+    """Telegram file_id of uploaded product photos stored in Redis"""
+
+    def __init__(self, redis_db: redis.client.Redis,
+                 redis_key: str = 'catalog:photos'):
+        self.redis_db = redis_db
+        self.redis_key = redis_key
+
+    def get(self, product_id: str) -> Optional[str]:
+        file_id = self.redis_db.hget(self.redis_key, product_id)
+        if file_id is None:
+            return None
+        return file_id.decode("utf-8")
+
+    def set(self, product_id: str, file_id: str) -> None:
+        self.redis_db.hset(self.redis_key, product_id, file_id)
+
+    def delete(self, product_id: str) -> None:
+        self.redis_db.hdel(self.redis_key, product_id)
+
+    def clear(self) -> None:
+        self.redis_db.delete(self.redis_key)
+
+
+def normalize_address(address: str) -> str:
+    """Return address in lower case without punctuation and extra spaces"""
+    address = address.lower().replace('ё', 'е')
+    address = re.sub(r'[^\w\s]', ' ', address)
+    return ' '.join(address.split())
+
+
+class GeocodeCache:
+    """Coordinates of geocoded addresses stored in Redis.
+
+    Addresses the geocoder has not found are cached too, but for
+    a shorter negative_ttl. Geocoder requests are rate limited and fail
+    fast while the geocoder is failing.
+    """
+
+    def __init__(self, redis_db: redis.client.Redis,
+                 ttl: int = 30 * 24 * 3600, negative_ttl: int = 24 * 3600,
+                 redis_prefix: str = 'geocode',
+                 geocoder_url: str = GEOCODER_URL, timeout: float = 5,
+                 rate_limit: float = 10, failure_threshold: int = 5,
+                 reset_timeout: float = 30):
+        self.redis_db = redis_db
+        self.geocoder_url = geocoder_url
+        self.timeout = timeout
+        self.circuit_breaker = CircuitBreaker(
+            'Yandex geocoder', failure_threshold, reset_timeout)
+        self.rate_limiter = RateLimiter('Yandex geocoder', rate_limit,
+                                        max_wait=timeout)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.redis_prefix = redis_prefix
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def fetch_coordinates(self, apikey: str,
+                          address: str) -> Optional[Tuple[float, float]]:
+        """Return cached coordinates of address, geocode it on miss"""
+        key = f'{self.redis_prefix}:{normalize_address(address)}'
+        coordinates = self.redis_db.get(key)
+        if coordinates is not None:
+            self._count(hit=True)
+            if not coordinates:
+                return None
+            lat, lon = coordinates.decode('utf-8').split(',')
+            return float(lat), float(lon)
+
+        self._count(hit=False)
+        coordinates = fetch_coordinates(
+            apikey, address, self.circuit_breaker, self.rate_limiter,
+            timeout=self.timeout, base_url=self.geocoder_url)
+        if coordinates is None:
+            self.redis_db.set(key, '', ex=self.negative_ttl)
+        else:
+            self.redis_db.set(key, '{},{}'.format(*coordinates), ex=self.ttl)
+        return coordinates
+
+    def _count(self, hit: bool) -> None:
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
@@ -0,0 +1,168 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
+from typing import List, Optional, Tuple
+
+import redis
+from requests.exceptions import HTTPError, RequestException
+
+from cache_tools import ProductCache
+from moltin_tools import MoltinSession, Product, add_products_in_cart, \
+    get_cart_quantities, remove_product_from_cart, update_cart_item
+
+logger = logging.getLogger(__name__)
+
+LOADED_FIELD = b'#'
+
+
+class CartMirror:
+    """Users' carts mirrored in Redis and written through to Moltin.
+
+    A cart is a hash of product id and quantity. Carts are changed and
+    rendered from Redis, and Moltin is brought to the same state in
+    background. A cart missing in Redis is loaded from Moltin once.
+    Syncs of one cart are serialized by a Redis lock, so the bot and the
+    jobs worker do not add the same products twice.
+    """
+
+    def __init__(self, redis_db: redis.client.Redis,
+                 moltin_client: MoltinSession, product_cache: ProductCache,
+                 ttl: int = 7 * 24 * 3600, key_prefix: str = 'cart',
+                 workers: int = 4, sync_delay: float = 2,
+                 sync_lock_timeout: float = 60):
+        self.redis_db = redis_db
+        self.moltin_client = moltin_client
+        self.product_cache = product_cache
+        self.ttl = ttl
+        self.key_prefix = key_prefix
+        self.sync_delay = sync_delay
+        self.sync_lock_timeout = sync_lock_timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._scheduled = set()
+        self._scheduled_lock = threading.Lock()
+        self._customer_locks = [threading.Lock() for _ in range(256)]
+
+    def get_key(self, customer_id: int) -> str:
+        return f'{self.key_prefix}:{customer_id}'
+
+    def get_items(self, customer_id: int) -> Tuple[List[Product], int]:
+        """Return products in user cart and total price"""
+        quantities = self._get_quantities(customer_id)
+        products = []
+        for product_id, quantity in quantities.items():
+            product = self._get_product(customer_id, product_id)
+            if product is not None:
+                products.append(replace(product, quantity=quantity))
+        total_price = sum(product.price_amount * product.quantity
+                          for product in products)
+        return products, total_price
+
+    def add(self, customer_id: int, product_id: str, amount: int) -> None:
+        self._get_quantities(customer_id)
+        key = self.get_key(customer_id)
+        pipeline = self.redis_db.pipeline()
+        pipeline.hincrby(key, product_id, amount)
+        pipeline.expire(key, self.ttl)
+        pipeline.execute()
+        self.sync_later(customer_id)
+
+    def remove(self, customer_id: int, product_id: str) -> None:
+        self._get_quantities(customer_id)
+        self.redis_db.hdel(self.get_key(customer_id), product_id)
+        self.sync_later(customer_id)
+
+    def sync(self, customer_id: int) -> None:
+        """Make Moltin cart the same as mirrored one"""
+        sync_lock = self.redis_db.lock(
+            f'{self.get_key(customer_id)}:sync',
+            timeout=self.sync_lock_timeout,
+            blocking_timeout=self.sync_lock_timeout)
+        with self._customer_locks[customer_id % len(self._customer_locks)], \
+                sync_lock:
+            with self._scheduled_lock:
+                self._scheduled.discard(customer_id)
+            quantities = self._get_quantities(customer_id)
+            remote_items = get_cart_quantities(customer_id,
+                                               self.moltin_client)
+            # Moltin adds amount of a product already in cart to it, so
+            # every increase goes in one request
+            added_amounts = {}
+            for product_id, quantity in list(quantities.items()):
+                item_id, remote_quantity = remote_items.get(product_id,
+                                                            (None, 0))
+                if quantity > remote_quantity and \
+                        self._get_product(customer_id, product_id) is None:
+                    del quantities[product_id]
+                elif quantity > remote_quantity:
+                    added_amounts[product_id] = quantity - remote_quantity
+                elif quantity < remote_quantity:
+                    update_cart_item(item_id, quantity, customer_id,
+                                     self.moltin_client)
+            if added_amounts:
+                add_products_in_cart(added_amounts, customer_id,
+                                     self.moltin_client)
+            for product_id, (item_id, _) in remote_items.items():
+                if product_id not in quantities:
+                    remove_product_from_cart(item_id, customer_id,
+                                             self.moltin_client)
+
+    def sync_later(self, customer_id: int) -> None:
+        """Sync cart in sync_delay seconds unless it is already waiting.
+
+        So several quick changes of a cart get to Moltin together.
+        """
+        with self._scheduled_lock:
+            if customer_id in self._scheduled:
+                return
+            self._scheduled.add(customer_id)
+        timer = threading.Timer(self.sync_delay, self._submit_sync,
+                                args=(customer_id,))
+        timer.daemon = True
+        timer.start()
+
+    def _submit_sync(self, customer_id: int) -> None:
+        try:
+            self._executor.submit(self._sync_in_background, customer_id)
+        except RuntimeError:
+            # The process is exiting, the cart is synced before the order
+            logger.warning(f'Cart {customer_id} was not synced on exit')
+
+    def _sync_in_background(self, customer_id: int) -> None:
+        try:
+            self.sync(customer_id)
+        except (RequestException, redis.RedisError) as error:
+            logger.error(f'Cart {customer_id} was not synced: {error}')
+
+    def _get_product(self, customer_id: int,
+                     product_id: str) -> Optional[Product]:
+        """Return product, drop it from cart if it is deleted in Moltin"""
+        try:
+            return self.product_cache.get_product(product_id)
+        except HTTPError as error:
+            if error.response is None or \
+                    error.response.status_code != 404:
+                raise
+        logger.warning(f'Deleted product {product_id} is dropped from '
+                       f'cart {customer_id}')
+        self.redis_db.hdel(self.get_key(customer_id), product_id)
+        return None
+
+    def _get_quantities(self, customer_id: int) -> dict:
+        key = self.get_key(customer_id)
+        cart = self.redis_db.hgetall(key)
+        if LOADED_FIELD not in cart:
+            remote_items = get_cart_quantities(customer_id,
+                                               self.moltin_client)
+            cart = {LOADED_FIELD: 1}
+            cart.update({product_id: quantity for product_id, (_, quantity)
+                         in remote_items.items()})
+            pipeline = self.redis_db.pipeline()
+            pipeline.hset(key, mapping=cart)
+            pipeline.expire(key, self.ttl)
+            pipeline.execute()
+            return {product_id: quantity for product_id, (_, quantity)
+                    in remote_items.items()}
+        return {product_id.decode('utf-8'): int(quantity)
+                for product_id, quantity in cart.items()
+                if product_id != LOADED_FIELD}
@@ -0,0 +1,184 @@
+"""Fake Moltin API with generated menu and pizzerias for local benchmarks"""
+import json
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+CENTER = (55.751244, 37.618423)
+
+
+def make_fake_product(number: int) -> dict:
+    return {
+        'id': f'product-{number}',
+        'type': 'product',
+        'name': f'Пицца {number}',
+        'slug': f'pizza-{number}',
+        'sku': f'pizza-{number}',
+        'description': f'Описание пиццы {number}',
+        'price': [{'amount': 300 + number * 10, 'currency': 'RUB',
+                   'includes_tax': True}],
+        'relationships': {
+            'main_image': {'data': {'type': 'main_image',
+                                    'id': f'file-{number}'}},
+        },
+    }
+
+
+def make_fake_pizzeria(number: int) -> dict:
+    return {
+        'id': f'pizzeria-{number}',
+        'type': 'entry',
+        'address': f'Москва, пиццерия {number}',
+        'alias': f'pizzeria-{number}',
+        'lat': str(CENTER[0] + (number % 10 - 5) * 0.01),
+        'lon': str(CENTER[1] + (number // 10 - 5) * 0.01),
+        'deliveryman_tg': str(900000 + number),
+    }
+
+
+class FakeMoltinApi:
+    """Moltin API which keeps products, flows and carts in memory"""
+
+    def __init__(self, products: int = 20, pizzerias: int = 30,
+                 latency: float = 0):
+        self.latency = latency
+        self.products = {product['id']: product for product in
+                         map(make_fake_product, range(products))}
+        self.entries = {
+            'pizza-address': {pizzeria['id']: pizzeria for pizzeria in
+                              map(make_fake_pizzeria, range(pizzerias))},
+            'customer-address': {},
+        }
+        self.carts = {}
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def call(self, method: str, path: str, query: dict,
+             body: Optional[dict]) -> Tuple[int, dict]:
+        with self._lock:
+            self.requests += 1
+        time.sleep(self.latency)
+        if path == '/oauth/access_token':
+            return 200, {'access_token': uuid.uuid4().hex,
+                         'expires': int(time.time()) + 3600}
+        if path == '/v2/products':
+            return 200, self.make_page(list(self.products.values()), query)
+        match = re.fullmatch(r'/v2/products/([^/]+)', path)
+        if match:
+            product = self.products.get(match.group(1))
+            if product is None:
+                return 404, {'errors': [{'status': 404}]}
+            return 200, {'data': product}
+        match = re.fullmatch(r'/v2/files/([^/]+)', path)
+        if match:
+            return 200, {'data': {'link': {
+                'href': f'https://example.com/{match.group(1)}.jpg'}}}
+        match = re.fullmatch(r'/v2/flows/([^/]+)/entries', path)
+        if match:
+            entries = self.entries.setdefault(match.group(1), {})
+            if method == 'GET':
+                return 200, self.make_page(list(entries.values()), query)
+            entry = dict(body['data'], id=uuid.uuid4().hex)
+            with self._lock:
+                entries[entry['id']] = entry
+            return 201, {'data': entry}
+        match = re.fullmatch(r'/v2/carts/([^/]+)/items(?:/([^/]+))?', path)
+        if match:
+            return self.call_cart(method, *match.groups(), body)
+        if path == '/v2/customers':
+            return 201, {'data': dict(body['data'], id=uuid.uuid4().hex)}
+        return 404, {'errors': [{'status': 404, 'detail': path}]}
+
+    def call_cart(self, method: str, cart_id: str, item_id: Optional[str],
+                  body: Optional[dict]) -> Tuple[int, dict]:
+        with self._lock:
+            cart = self.carts.setdefault(cart_id, {})
+            if method == 'POST':
+                items = body['data']
+                for item in items if isinstance(items, list) else [items]:
+                    self.add_cart_item(cart, item['id'], item['quantity'])
+            elif method == 'PUT':
+                cart[item_id]['quantity'] = body['data']['quantity']
+            elif method == 'DELETE':
+                cart.pop(item_id, None)
+            items = [dict(item) for item in cart.values()]
+        total_price = sum(item['unit_price']['amount'] * item['quantity']
+                          for item in items)
+        return 200, {
+            'data': items,
+            'meta': {'display_price': {'with_tax': {'amount': total_price}}},
+        }
+
+    def add_cart_item(self, cart: dict, product_id: str,
+                      quantity: int) -> None:
+        for item in cart.values():
+            if item['product_id'] == product_id:
+                item['quantity'] += quantity
+                return
+        product = self.products[product_id]
+        item_id = uuid.uuid4().hex
+        cart[item_id] = {
+            'id': item_id,
+            'product_id': product_id,
+            'name': product['name'],
+            'description': product['description'],
+            'image': {'href': ''},
+            'unit_price': {'amount': product['price'][0]['amount'],
+                           'currency': 'RUB'},
+            'quantity': quantity,
+        }
+
+    @staticmethod
+    def make_page(items: List[dict], query: dict) -> dict:
+        limit = int(query.get('page[limit]', ['100'])[0])
+        offset = int(query.get('page[offset]', ['0'])[0])
+        has_next = offset + limit < len(items)
+        return {
+            'data': items[offset:offset + limit],
+            'links': {'next': 'next' if has_next else None},
+        }
+
+
+def start_fake_moltin_api(port: int = 0, **kwargs
+                          ) -> (ThreadingHTTPServer, FakeMoltinApi):
+    """Serve Moltin API at http://localhost:<port>"""
+    moltin_api = FakeMoltinApi(**kwargs)
+
+    class RequestHandler(BaseHTTPRequestHandler):
+        def handle_method(self, method: str):
+            url = urlparse(self.path)
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            json_body = None
+            if 'json' in self.headers.get('Content-Type', ''):
+                json_body = json.loads(body or b'{}')
+            status, answer = moltin_api.call(method, url.path,
+                                             parse_qs(url.query), json_body)
+            content = json.dumps(answer).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def do_GET(self):
+            self.handle_method('GET')
+
+        def do_POST(self):
+            self.handle_method('POST')
+
+        def do_PUT(self):
+            self.handle_method('PUT')
+
+        def do_DELETE(self):
+            self.handle_method('DELETE')
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('0.0.0.0', port), RequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, moltin_api
@@ -0,0 +1,180 @@
+"""Fake Telegram to try the bot in webhook mode locally.
+
+Start it, run router and workers with TELEGRAM_API_URL printed by the
+script, and it sends users' updates to the router, then reports what the
+bot answered to every chat.
+"""
+import argparse
+import json
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from typing import Dict, List
+
+import requests
+
+FAKE_BOT = {
+    'id': 1,
+    'is_bot': True,
+    'first_name': 'Fake',
+    'username': 'fake_bot',
+}
+
+
+class FakeBotApi:
+    """Bot API which records requests of the bot and answers them"""
+
+    def __init__(self):
+        self.requests = defaultdict(list)
+        self._message_ids = count(1)
+        self._lock = threading.Lock()
+
+    def make_message(self, chat_id: int, **fields) -> dict:
+        return {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id), 'type': 'private'},
+            **fields,
+        }
+
+    def call(self, method: str, params: dict):
+        chat_id = params.get('chat_id', 0)
+        with self._lock:
+            self.requests[int(chat_id)].append(method)
+        if method == 'getMe':
+            return FAKE_BOT
+        if method == 'sendPhoto':
+            photo = params.get('photo')
+            file_id = photo if isinstance(photo, str) and \
+                not photo.startswith('http') else f'file-{time.time()}'
+            return self.make_message(chat_id, photo=[{
+                'file_id': file_id,
+                'file_unique_id': file_id,
+                'width': 1,
+                'height': 1,
+            }])
+        if method.startswith('send'):
+            return self.make_message(chat_id, text=params.get('text'))
+        return True
+
+
+def start_fake_bot_api(port: int) -> (ThreadingHTTPServer, FakeBotApi):
+    """Serve Bot API at http://localhost:<port>/bot<token>/<method>"""
+    bot_api = FakeBotApi()
+
+    class RequestHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            method = self.path.rstrip('/').split('/')[-1]
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            params = {}
+            if 'json' in self.headers.get('Content-Type', ''):
+                params = json.loads(body or b'{}')
+            content = json.dumps({
+                'ok': True,
+                'result': bot_api.call(method, params),
+            }).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        do_GET = do_POST
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('0.0.0.0', port), RequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, bot_api
+
+
+def make_user(chat_id: int) -> dict:
+    return {'id': chat_id, 'is_bot': False, 'first_name': f'User{chat_id}'}
+
+
+def make_text_update(update_id: int, chat_id: int, text: str) -> dict:
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'private'},
+        'from': make_user(chat_id),
+        'text': text,
+    }
+    if text.startswith('/'):
+        message['entities'] = [
+            {'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+    return {'update_id': update_id, 'message': message}
+
+
+def make_callback_update(update_id: int, chat_id: int, data: str) -> dict:
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'from': make_user(chat_id),
+            'chat_instance': str(chat_id),
+            'data': data,
+            'message': {
+                'message_id': update_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'text': 'Please choose:',
+            },
+        },
+    }
+
+
+def make_journey(chat_id: int, update_ids: count) -> List[dict]:
+    """Return updates of user who opens menu and cart and goes back"""
+    return [
+        make_text_update(next(update_ids), chat_id, '/start'),
+        make_callback_update(next(update_ids), chat_id, 'cart'),
+        make_callback_update(next(update_ids), chat_id, 'menu'),
+        make_callback_update(next(update_ids), chat_id, 'cart'),
+        make_callback_update(next(update_ids), chat_id, 'address'),
+    ]
+
+
+def send_updates(router_url: str, updates: List[dict],
+                 secret_token: str = None) -> None:
+    headers = {}
+    if secret_token:
+        headers['X-Telegram-Bot-Api-Secret-Token'] = secret_token
+    with requests.Session() as session:
+        for update in updates:
+            response = session.post(router_url, json=update, headers=headers)
+            response.raise_for_status()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--router-url',
+                        default='http://localhost:8443/telegram')
+    parser.add_argument('--bot-api-port', type=int, default=8081)
+    parser.add_argument('--chats', type=int, default=10)
+    parser.add_argument('--secret-token')
+    parser.add_argument('--wait', type=float, default=10,
+                        help='seconds to wait for bot answers')
+    args = parser.parse_args()
+
+    _, bot_api = start_fake_bot_api(args.bot_api_port)
+    print(f'TELEGRAM_API_URL=http://localhost:{args.bot_api_port}/bot')
+    input('Start router and workers, then press Enter')
+
+    update_ids = count(1)
+    journeys = [make_journey(chat_id, update_ids)
+                for chat_id in range(1000, 1000 + args.chats)]
+    updates = [update for steps in zip(*journeys) for update in steps]
+    send_updates(args.router_url, updates, args.secret_token)
+    time.sleep(args.wait)
+
+    answers: Dict[int, List[str]] = dict(bot_api.requests)
+    for chat_id in range(1000, 1000 + args.chats):
+        print(chat_id, ' '.join(answers.get(chat_id, [])))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,38 @@
-from functools import partial
+import heapq
+from itertools import count
+from math import cos, radians, sin
+from typing import List, NamedTuple, Optional, Tuple
 
+import numpy as np
 import requests
 from geopy import distance
+from requests.adapters import HTTPAdapter
 
+from metrics_tools import timed
 from moltin_tools import PizzaAddress
+from resilience_tools import CircuitBreaker, RateLimiter, \
+    send_guarded_request
 
+GEOCODER_URL = "https://geocode-maps.yandex.ru/1.x"
 
-def fetch_coordinates(apikey: str, address: str) -> (float, float):
-    base_url = "https://geocode-maps.yandex.ru/1.x"
-    response = requests.get(base_url, params={
-        "geocode": address,
-        "apikey": apikey,
-        "format": "json",
-    })
+geocoder_session = requests.Session()
+geocoder_adapter = HTTPAdapter(pool_maxsize=32)
+geocoder_session.mount('https://', geocoder_adapter)
+geocoder_session.mount('http://', geocoder_adapter)
+
+
+@timed('yandex_call_seconds')
+def fetch_coordinates(apikey: str, address: str,
+                      circuit_breaker: CircuitBreaker,
+                      rate_limiter: RateLimiter, timeout: float = 5,
+                      base_url: str = GEOCODER_URL) -> (float, float):
+    response = send_guarded_request(
+        geocoder_session, 'GET', base_url, circuit_breaker, rate_limiter,
+        params={
+            "geocode": address,
+            "apikey": apikey,
+            "format": "json",
+        }, timeout=timeout)
     response.raise_for_status()
     found_places = response.json()['response']['GeoObjectCollection'][
         'featureMember']
@@ -31,10 +51,171 @@ def get_address_dist(pizza_address, user_address):
     return distance.distance(pizza_location, user_address).meters
 
 
-def get_min_dist(pizza_addresses, user_address) -> (PizzaAddress, int):
-    get_address_dist_with_args = partial(get_address_dist,
-                                         user_address=user_address)
-    nearest_address = min(pizza_addresses, key=get_address_dist_with_args)
-    dist_to_nearest_address = int(
-        round(get_address_dist(nearest_address, user_address), 0))
+Point = Tuple[float, float, float]
+
+# Mean Earth radius of WGS-84 ellipsoid in meters
+EARTH_RADIUS = 6371008.8
+
+# Ellipsoid geodesic and sphere chord orders points slightly differently,
+# so pizzerias a bit further than k-th nearest by chord are checked too
+SHORTLIST_MARGIN = 1.01
+
+
+class KDNode(NamedTuple):
+    point: Point
+    pizza_address: PizzaAddress
+    axis: int
+    left: Optional['KDNode']
+    right: Optional['KDNode']
+
+
+def to_unit_vector(lat, lon) -> Point:
+    """Return point on unit sphere for latitude and longitude"""
+    lat, lon = radians(float(lat)), radians(float(lon))
+    return cos(lat) * cos(lon), cos(lat) * sin(lon), sin(lat)
+
+
+def get_squared_chord(point: Point, other_point: Point) -> float:
+    return sum((a - b) ** 2 for a, b in zip(point, other_point))
+
+
+def build_kd_tree(points: List[Tuple[Point, PizzaAddress]],
+                  depth: int = 0) -> Optional[KDNode]:
+    if not points:
+        return None
+    axis = depth % 3
+    points = sorted(points, key=lambda point: point[0][axis])
+    median = len(points) // 2
+    return KDNode(
+        point=points[median][0],
+        pizza_address=points[median][1],
+        axis=axis,
+        left=build_kd_tree(points[:median], depth + 1),
+        right=build_kd_tree(points[median + 1:], depth + 1),
+    )
+
+
+class AddressIndex:
+    """k-d tree of pizzerias for nearest pizzeria lookup.
+
+    Cheap chord distance on a unit sphere shortlists candidates and exact
+    geodesic distance is calculated only for them.
+    """
+
+    def __init__(self, pizza_addresses: List[PizzaAddress]):
+        self.pizza_addresses = list(pizza_addresses)
+        self._root = build_kd_tree(
+            [(to_unit_vector(address.lat, address.lon), address)
+             for address in self.pizza_addresses])
+
+    def nearest(self, user_address, k: int = 1) -> List[
+            Tuple[PizzaAddress, int]]:
+        """Return k nearest pizzerias with distance in meters to them"""
+        if self._root is None:
+            raise ValueError('Index has no pizza addresses')
+        target = to_unit_vector(*user_address)
+        shortlist = self._find_nearest(target, k)
+        radius = max(squared_chord for squared_chord, _ in shortlist)
+        candidates = self._find_within(target,
+                                       radius * SHORTLIST_MARGIN ** 2)
+        distances = sorted(
+            ((address, get_address_dist(address, user_address))
+             for address in candidates),
+            key=lambda address_dist: address_dist[1])
+        return [(address, int(round(dist, 0)))
+                for address, dist in distances[:k]]
+
+    def _find_nearest(self, target: Point, k: int) -> List[
+            Tuple[float, PizzaAddress]]:
+        heap = []
+        counter = count()
+
+        def visit(node: Optional[KDNode]):
+            if node is None:
+                return
+            squared_chord = get_squared_chord(node.point, target)
+            item = (-squared_chord, next(counter), node.pizza_address)
+            if len(heap) < k:
+                heapq.heappush(heap, item)
+            elif squared_chord < -heap[0][0]:
+                heapq.heapreplace(heap, item)
+
+            diff = target[node.axis] - node.point[node.axis]
+            near, far = (node.left, node.right) if diff < 0 else \
+                (node.right, node.left)
+            visit(near)
+            if len(heap) < k or diff ** 2 < -heap[0][0]:
+                visit(far)
+
+        visit(self._root)
+        return [(-squared_chord, address)
+                for squared_chord, _, address in heap]
+
+    def _find_within(self, target: Point,
+                     radius: float) -> List[PizzaAddress]:
+        found_addresses = []
+        nodes = [self._root]
+        while nodes:
+            node = nodes.pop()
+            if node is None:
+                continue
+            if get_squared_chord(node.point, target) <= radius:
+                found_addresses.append(node.pizza_address)
+            diff = target[node.axis] - node.point[node.axis]
+            if diff < 0 or diff ** 2 <= radius:
+                nodes.append(node.left)
+            if diff >= 0 or diff ** 2 <= radius:
+                nodes.append(node.right)
+        return found_addresses
+
+
+def get_min_dist(address_index: AddressIndex,
+                 user_address) -> (PizzaAddress, int):
+    nearest_address, dist_to_nearest_address = address_index.nearest(
+        user_address)[0]
     return nearest_address, dist_to_nearest_address
+
+
+def get_batch_dist(pizza_addresses: List[PizzaAddress],
+                   user_addresses) -> np.ndarray:
+    """Return users x pizzerias matrix of haversine distances in meters"""
+    user_points = np.radians(np.asarray(user_addresses, dtype=float))
+    pizza_points = np.radians(np.array(
+        [(address.lat, address.lon) for address in pizza_addresses],
+        dtype=float))
+    user_lat = user_points[:, 0, np.newaxis]
+    user_lon = user_points[:, 1, np.newaxis]
+    pizza_lat = pizza_points[np.newaxis, :, 0]
+    pizza_lon = pizza_points[np.newaxis, :, 1]
+
+    haversine = np.sin((pizza_lat - user_lat) / 2) ** 2 + \
+        np.cos(user_lat) * np.cos(pizza_lat) * \
+        np.sin((pizza_lon - user_lon) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(haversine, 0, 1)))
+
+
+def get_batch_min_dist(pizza_addresses: List[PizzaAddress],
+                       user_addresses) -> (np.ndarray, np.ndarray):
+    """Return index of nearest pizzeria for each user and distance matrix"""
+    dist_matrix = get_batch_dist(pizza_addresses, user_addresses)
+    return dist_matrix.argmin(axis=1), dist_matrix
+
+
+def check_batch_accuracy(pizza_addresses: List[PizzaAddress],
+                         user_addresses, sample_size: int = 100) -> float:
+    """Return max relative error of batch distances against geopy"""
+    user_addresses = np.asarray(user_addresses, dtype=float)
+    random = np.random.default_rng()
+    users = random.integers(len(user_addresses), size=sample_size)
+    pizzerias = random.integers(len(pizza_addresses), size=sample_size)
+    dist_matrix = get_batch_dist(pizza_addresses, user_addresses[users])
+
+    max_error = 0
+    for row, (user, pizzeria) in enumerate(zip(users, pizzerias)):
+        exact_dist = get_address_dist(pizza_addresses[pizzeria],
+                                      tuple(user_addresses[user]))
+        if not exact_dist:
+            continue
+        error = abs(dist_matrix[row, pizzeria] - exact_dist) / exact_dist
+        max_error = max(max_error, error)
+    return max_error
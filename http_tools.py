@@ -0,0 +1,51 @@
+import logging
+import threading
+from http.client import HTTPMessage
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Tuple
+
+logger = logging.getLogger(__name__)
+
+RouteHandler = Callable[[bytes, HTTPMessage], Tuple[int, str]]
+
+
+def start_http_server(port: int, routes: Dict[Tuple[str, str], RouteHandler],
+                      host: str = '0.0.0.0') -> ThreadingHTTPServer:
+    """Serve routes {(method, path): handler} in a background thread.
+
+    Handler gets request body and headers and returns status and text.
+    """
+
+    class RequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.handle_route('GET')
+
+        def do_POST(self):
+            self.handle_route('POST')
+
+        def handle_route(self, method: str):
+            route_handler = routes.get((method, self.path.split('?')[0]))
+            if route_handler is None:
+                self.send_error(404)
+                return
+            content_length = int(self.headers.get('Content-Length', 0))
+            body = self.rfile.read(content_length)
+            try:
+                status, text = route_handler(body, self.headers)
+            except Exception as err:
+                logger.exception(err)
+                self.send_error(500)
+                return
+            content = text.encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'text/plain; charset=utf-8')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+    server = ThreadingHTTPServer((host, port), RequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,154 @@
+import json
+import logging
+import threading
+import time
+import uuid
+from typing import Callable, Dict, List
+
+import redis
+
+logger = logging.getLogger(__name__)
+
+JobHandlers = Dict[str, Callable[..., None]]
+
+# Due jobs are moved atomically, so each of them is queued exactly once
+# however many workers move them
+MOVE_DUE_JOBS_SCRIPT = """
+local jobs = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1],
+                        'LIMIT', 0, ARGV[2])
+for _, job in ipairs(jobs) do
+    redis.call('ZREM', KEYS[1], job)
+    redis.call('LPUSH', KEYS[2], job)
+end
+return #jobs
+"""
+
+
+def make_job(name: str, kwargs: dict) -> dict:
+    return {
+        'id': uuid.uuid4().hex,
+        'name': name,
+        'kwargs': kwargs,
+        'attempts': 0,
+    }
+
+
+class RedisJobQueue:
+    """Durable queue of jobs in Redis list handled by worker processes.
+
+    A taken job stays in the worker's processing list until it is handled,
+    so jobs of a crashed worker are put back when it starts again. Delayed
+    jobs wait in a sorted set by time they are due and workers move them
+    to the queue. Failed jobs are retried with growing delay up to
+    max_attempts times, then kept in failed list.
+    """
+
+    def __init__(self, redis_db: redis.client.Redis, queue: str = 'jobs',
+                 max_attempts: int = 5, retry_delay: float = 10):
+        self.redis_db = redis_db
+        self.queue = queue
+        self.scheduled_queue = f'{queue}:scheduled'
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._move_due_jobs = redis_db.register_script(MOVE_DUE_JOBS_SCRIPT)
+
+    def get_processing_queue(self, worker_id: str) -> str:
+        return f'{self.queue}:processing:{worker_id}'
+
+    def enqueue(self, name: str, **kwargs) -> str:
+        """Put job into the queue and return its id"""
+        job = make_job(name, kwargs)
+        self._push(self.queue, job)
+        return job['id']
+
+    def enqueue_in(self, delay: float, name: str, **kwargs) -> str:
+        """Put job into the queue in delay seconds and return its id"""
+        job = make_job(name, kwargs)
+        self._schedule(time.time() + delay, job)
+        return job['id']
+
+    def move_due_jobs(self, limit: int = 100) -> int:
+        """Move jobs which are due to the queue and return their number"""
+        return self._move_due_jobs(
+            keys=[self.scheduled_queue, self.queue],
+            args=[time.time(), limit])
+
+    def handle(self, job_handlers: JobHandlers, raw_job: bytes) -> None:
+        """Run job handler, put failed job back or to failed jobs"""
+        job = json.loads(raw_job)
+        try:
+            job_handlers[job['name']](**job['kwargs'])
+        except Exception as error:
+            job['attempts'] += 1
+            if job['attempts'] >= self.max_attempts:
+                logger.error(f'Job {job["name"]} {job["id"]} failed: '
+                             f'{error}')
+                self._push(f'{self.queue}:failed', job)
+            else:
+                logger.warning(f'Job {job["name"]} {job["id"]} will be '
+                               f'retried: {error}')
+                delay = self.retry_delay * 2 ** (job['attempts'] - 1)
+                self._schedule(time.time() + delay, job)
+            return
+        logger.info(f'Job {job["name"]} {job["id"]} done')
+
+    def consume(self, job_handlers: JobHandlers, worker_id: str) -> None:
+        """Handle jobs one by one, starting over after Redis errors"""
+        processing_queue = self.get_processing_queue(worker_id)
+        while True:
+            try:
+                self._consume(job_handlers, processing_queue)
+            except redis.RedisError as error:
+                logger.error(f'Jobs were not taken from {self.queue}: '
+                             f'{error}')
+                time.sleep(1)
+
+    def schedule(self) -> None:
+        """Move due jobs to the queue every second"""
+        while True:
+            try:
+                while self.move_due_jobs() > 0:
+                    pass
+            except redis.RedisError as error:
+                logger.error(f'Scheduled jobs were not moved: {error}')
+            time.sleep(1)
+
+    def start_workers(self, job_handlers: JobHandlers, worker_id: str,
+                      threads: int = 4) -> List[threading.Thread]:
+        """Start handling jobs in several background threads"""
+        workers = [
+            threading.Thread(target=self.consume,
+                             args=(job_handlers, f'{worker_id}:{number}'),
+                             daemon=True)
+            for number in range(threads)]
+        workers.append(threading.Thread(target=self.schedule, daemon=True))
+        for worker in workers:
+            worker.start()
+        logger.info(f'Handling jobs of {self.queue} in {threads} threads')
+        return workers
+
+    def run_workers(self, job_handlers: JobHandlers, worker_id: str,
+                    threads: int = 4) -> None:
+        """Handle jobs in several threads"""
+        for worker in self.start_workers(job_handlers, worker_id, threads):
+            worker.join()
+
+    def _push(self, queue: str, job: dict) -> None:
+        self.redis_db.lpush(queue, json.dumps(job, ensure_ascii=False))
+
+    def _schedule(self, run_at: float, job: dict) -> None:
+        self.redis_db.zadd(self.scheduled_queue,
+                           {json.dumps(job, ensure_ascii=False): run_at})
+
+    def _consume(self, job_handlers: JobHandlers,
+                 processing_queue: str) -> None:
+        # Jobs left by a stopped or failed consumer are taken again
+        while self.redis_db.rpoplpush(processing_queue, self.queue):
+            pass
+        while True:
+            raw_job = self.redis_db.brpoplpush(self.queue, processing_queue,
+                                               timeout=1)
+            if raw_job is None:
+                continue
+            self.handle(job_handlers, raw_job)
+            self.redis_db.lrem(processing_queue, 1, raw_job)
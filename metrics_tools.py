@@ -0,0 +1,155 @@
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Tuple
+
+import redis
+from redis.client import Pipeline
+from telegram import Bot
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+                    10)
+
+
+class Histogram:
+    """Durations counted by buckets like Prometheus histogram"""
+
+    def __init__(self):
+        self.counts = [0] * (len(DURATION_BUCKETS) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(DURATION_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    """Histograms of durations and gauges rendered in Prometheus format.
+
+    If log_observations is set every observation is also logged as JSON
+    by 'metrics' logger.
+    """
+
+    def __init__(self, log_observations: bool = False):
+        self.log_observations = log_observations
+        self._histograms = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(seconds)
+        if self.log_observations:
+            logging.getLogger('metrics').info(json.dumps(
+                {'metric': name, 'seconds': round(seconds, 6), **labels},
+                ensure_ascii=False))
+
+    def add_gauge(self, name: str, get_value: Callable[[], float]) -> None:
+        """Export value returned by get_value on every scrape"""
+        self._gauges[name] = get_value
+
+    def render(self) -> str:
+        """Return metrics in Prometheus text format"""
+        with self._lock:
+            histograms = {
+                key: (list(histogram.counts), histogram.sum, histogram.count)
+                for key, histogram in self._histograms.items()}
+        lines = []
+        typed_names = set()
+        for (name, labels), (counts, total, count) in sorted(
+                histograms.items()):
+            if name not in typed_names:
+                lines.append(f'# TYPE {name} histogram')
+                typed_names.add(name)
+            cumulative_count = 0
+            for bucket, bucket_count in zip(DURATION_BUCKETS + ('+Inf',),
+                                            counts):
+                cumulative_count += bucket_count
+                bucket_labels = format_labels(labels + (('le', bucket),))
+                lines.append(
+                    f'{name}_bucket{bucket_labels} {cumulative_count}')
+            lines.append(f'{name}_sum{format_labels(labels)} {total}')
+            lines.append(f'{name}_count{format_labels(labels)} {count}')
+        for name, get_value in sorted(self._gauges.items()):
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {get_value()}')
+        return '\n'.join(lines) + '\n'
+
+
+def escape_label_value(value: object) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def format_labels(labels: Tuple[Tuple[str, object], ...]) -> str:
+    if not labels:
+        return ''
+    formatted_labels = ','.join(f'{label}="{escape_label_value(value)}"'
+                                for label, value in labels)
+    return f'{{{formatted_labels}}}'
+
+
+metrics = MetricsRegistry()
+
+
+@contextmanager
+def measure(name: str, **labels):
+    """Observe duration of the block in seconds"""
+    started_at = time.monotonic()
+    try:
+        yield
+    finally:
+        metrics.observe(name, time.monotonic() - started_at, **labels)
+
+
+def timed(name: str, **labels):
+    """Observe duration of every call labeled by function name"""
+
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with measure(name, function=function.__name__, **labels):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def handle_metrics_request(body: bytes, headers) -> Tuple[int, str]:
+    return 200, metrics.render()
+
+
+class TimedPipeline(Pipeline):
+    def execute(self, raise_on_error: bool = True):
+        with measure('redis_command_seconds', command='PIPELINE'):
+            return super().execute(raise_on_error)
+
+
+class TimedRedis(redis.Redis):
+    """Redis client which observes duration of every command"""
+
+    def execute_command(self, *args, **options):
+        with measure('redis_command_seconds', command=str(args[0]).upper()):
+            return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction: bool = True, shard_hint=None):
+        return TimedPipeline(self.connection_pool, self.response_callbacks,
+                             transaction, shard_hint)
+
+
+class TimedBot(Bot):
+    """Telegram bot which observes duration of every Bot API request"""
+
+    def _post(self, endpoint: str, *args, **kwargs):
+        with measure('telegram_request_seconds', method=endpoint):
+            return super()._post(endpoint, *args, **kwargs)
+
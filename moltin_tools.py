@@ -1,17 +1,151 @@
-from dataclasses import dataclass
-from datetime import datetime
-from typing import NamedTuple, List
-
+import json
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from functools import partial
+from typing import Any, Callable, Dict, Hashable, Iterator, NamedTuple, \
+    List, Optional, Tuple
+
+import redis
 import requests
 from dacite import from_dict
+from requests.adapters import HTTPAdapter
 from slugify import slugify
-
-motlin_token, token_expires_timestamp = None, None
-
-
-class MoltinClient(NamedTuple):
-    client_id: str
-    client_secret: str
+from urllib3.util.retry import Retry
+
+from metrics_tools import timed
+from resilience_tools import CircuitBreaker, RateLimiter, \
+    send_guarded_request
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimitRetry(Retry):
+    """Retry which also repeats non idempotent requests rejected with 429.
+
+    Moltin does not process such requests, so POST is safe to repeat after
+    Retry-After.
+    """
+
+    def is_retry(self, method: str, status_code: int,
+                 has_retry_after: bool = False) -> bool:
+        if status_code == 429 and self.total:
+            return True
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+class SingleFlight:
+    """Calls with equal key made at the same time share one call"""
+
+    def __init__(self):
+        self.deduplicated = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, function: Callable[[], Any]) -> Any:
+        """Return result of function or of the same call in progress"""
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = Future()
+                self._calls[key] = call
+            else:
+                self.deduplicated += 1
+        if not is_leader:
+            return call.result()
+        try:
+            call.set_result(function())
+        except BaseException as error:
+            call.set_exception(error)
+        finally:
+            with self._lock:
+                del self._calls[key]
+        return call.result()
+
+
+class MoltinSession:
+    """Moltin credentials with a pooled keep-alive HTTP session.
+
+    Requests are rate limited and fail fast while Moltin is failing. If
+    redis_db is passed the access token is shared between processes.
+    Requests rejected with 429 are repeated after Retry-After only if
+    retry_rate_limited is set, otherwise rate_limiter slows down, so a
+    long Retry-After does not block the caller. Timed out requests are
+    repeated only if retry_timeouts is set, otherwise one request takes
+    at most timeout and every timeout counts in circuit_breaker.
+    """
+
+    def __init__(self, client_id: str, client_secret: str,
+                 base_url: str = 'https://api.moltin.com',
+                 pool_size: int = 10, timeout: float = 10,
+                 retries: int = 3, backoff_factor: float = 0.3,
+                 redis_db: redis.client.Redis = None,
+                 rate_limit: float = 20, failure_threshold: int = 5,
+                 reset_timeout: float = 30,
+                 retry_rate_limited: bool = False,
+                 retry_timeouts: bool = False):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.token_manager = TokenManager(self, redis_db=redis_db)
+        self.single_flight = SingleFlight()
+        self.circuit_breaker = CircuitBreaker('Moltin', failure_threshold,
+                                              reset_timeout)
+        self.rate_limiter = RateLimiter('Moltin', rate_limit,
+                                        max_wait=timeout)
+
+        retry_class = RateLimitRetry if retry_rate_limited else Retry
+        retry = retry_class(
+            total=retries,
+            connect=None if retry_timeouts else 0,
+            read=None if retry_timeouts else 0,
+            backoff_factor=backoff_factor,
+            status_forcelist=(500, 502, 503, 504),
+            raise_on_status=False,
+            respect_retry_after_header=retry_rate_limited,
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size,
+                              max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method: str, path: str,
+                **kwargs) -> requests.Response:
+        """Send request to Moltin API through the pooled session"""
+        kwargs.setdefault('timeout', self.timeout)
+        return send_guarded_request(self.session, method,
+                                    f'{self.base_url}{path}',
+                                    self.circuit_breaker, self.rate_limiter,
+                                    **kwargs)
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        """Send GET request, identical concurrent ones share the response"""
+        key = (path, json.dumps(kwargs, sort_keys=True, default=str))
+        return self.single_flight.do(key, partial(self._get, path, kwargs))
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        return self.request('POST', path, **kwargs)
+
+    def put(self, path: str, **kwargs) -> requests.Response:
+        return self.request('PUT', path, **kwargs)
+
+    def delete(self, path: str, **kwargs) -> requests.Response:
+        return self.request('DELETE', path, **kwargs)
+
+    def _get(self, path: str, kwargs: dict) -> requests.Response:
+        response = self.request('GET', path, **kwargs)
+        # Body is read once here, so threads sharing it can parse it
+        response.content
+        return response
+
+    def close(self) -> None:
+        self.session.close()
 
 
 class MoltinFlow(NamedTuple):
@@ -34,6 +168,7 @@ class Product:
     price_amount: str = None
     price_currency: str = 'RUB'
     quantity: int = 0
+    sku: str = None
 
 
 @dataclass()
@@ -46,23 +181,104 @@ class PizzaAddress:
     id: str = None
 
 
-def is_valid_token(token_expires_timestamp: int) -> bool:
-    """Return whether token has expired"""
-    now_datetime = datetime.now()
-    token_expires_datetime = datetime.fromtimestamp(token_expires_timestamp)
-    return now_datetime < token_expires_datetime
-
-
-def get_motlin_access_token(moltin_client: MoltinClient) -> str:
+class TokenManager:
+    """Moltin access token refreshed by one thread at a time.
+
+    With start_refreshing the token is refreshed in background before it
+    expires, so requests do not wait for authorization. If redis_db is
+    passed the token is shared between processes and only one of them
+    authorizes at a time.
+    """
+
+    def __init__(self, moltin_client: 'MoltinSession',
+                 refresh_margin: int = 300,
+                 redis_db: redis.client.Redis = None,
+                 redis_key: str = 'moltin:token'):
+        self.moltin_client = moltin_client
+        self.refresh_margin = refresh_margin
+        self.redis_db = redis_db
+        self.redis_key = redis_key
+        self._token = None
+        self._lock = threading.Lock()
+
+    def get_token(self) -> str:
+        """Return valid access token, authorize if there is none"""
+        token = self._token
+        if token is not None and time.time() < token.expires:
+            return token.access_token
+        with self._lock:
+            token = self._token
+            if token is None or time.time() >= token.expires:
+                token = self._get_new_token()
+                self._token = token
+        return token.access_token
+
+    def refresh(self) -> None:
+        with self._lock:
+            self._token = self._get_new_token()
+
+    def start_refreshing(self) -> None:
+        threading.Thread(target=self._refresh_periodically,
+                         daemon=True).start()
+
+    def _needs_refresh(self, token: Optional[Token]) -> bool:
+        return token is None or \
+            time.time() >= token.expires - self.refresh_margin
+
+    def _get_new_token(self) -> Token:
+        if self.redis_db is None:
+            return make_authorization(self.moltin_client)
+        token = self._load_shared()
+        if not self._needs_refresh(token):
+            return token
+        # Lock is released only by its owner if authorizing takes longer
+        authorization_lock = self.redis_db.lock(f'{self.redis_key}:lock',
+                                                timeout=30)
+        if authorization_lock.acquire(blocking=False):
+            try:
+                token = make_authorization(self.moltin_client)
+                self.redis_db.set(
+                    self.redis_key, json.dumps(token._asdict()),
+                    ex=max(int(token.expires - time.time()), 1))
+            finally:
+                try:
+                    authorization_lock.release()
+                except redis.exceptions.LockError:
+                    logger.warning('Moltin token lock expired')
+            return token
+        # Another process is authorizing, wait for its token
+        for _ in range(50):
+            time.sleep(0.1)
+            token = self._load_shared()
+            if not self._needs_refresh(token):
+                return token
+        return make_authorization(self.moltin_client)
+
+    def _load_shared(self) -> Optional[Token]:
+        shared_token = self.redis_db.get(self.redis_key)
+        if shared_token is None:
+            return None
+        return Token(**json.loads(shared_token))
+
+    def _refresh_periodically(self) -> None:
+        while True:
+            try:
+                self.refresh()
+            except (requests.RequestException, redis.RedisError) as error:
+                logger.error(f'Moltin token was not refreshed: {error}')
+                time.sleep(10)
+                continue
+            time.sleep(max(self._token.expires - self.refresh_margin
+                           - time.time(), 10))
+
+
+def get_motlin_access_token(moltin_client: MoltinSession) -> str:
     """Return motlin access token"""
-    global motlin_token, token_expires_timestamp
-    if (motlin_token is None) or (not is_valid_token(token_expires_timestamp)):
-        motlin_token, token_expires_timestamp = make_authorization(
-            moltin_client)
-    return motlin_token
+    return moltin_client.token_manager.get_token()
 
 
-def make_authorization(moltin_client: MoltinClient) -> Token:
+@timed('moltin_call_seconds')
+def make_authorization(moltin_client: MoltinSession) -> Token:
     """Return created access_token and expires of token"""
     data = {
         'client_id': moltin_client.client_id,
@@ -70,53 +286,134 @@ def make_authorization(moltin_client: MoltinClient) -> Token:
         'grant_type': 'client_credentials',
     }
 
-    response = requests.post('https://api.moltin.com/oauth/access_token',
-                             data=data)
+    response = moltin_client.post('/oauth/access_token',
+                                  data=data)
     response.raise_for_status()
     authorization = response.json()
     return Token(access_token=authorization.get("access_token"),
                  expires=authorization.get("expires"))
 
 
-def get_all_products(moltin_client: MoltinClient) -> [Product]:
-    """Return list if Product class with product's id and name"""
-    motlin_access_token = get_motlin_access_token(moltin_client)
-    headers = {
-        'Authorization': f'Bearer {motlin_access_token}',
-    }
+def iter_pages(path: str, moltin_client: MoltinSession,
+               page_limit: int = 100,
+               prefetch: bool = False) -> Iterator[List[dict]]:
+    """Yield data of every page of Moltin list endpoint.
 
-    response = requests.get('https://api.moltin.com/v2/products',
-                            headers=headers)
-    response.raise_for_status()
-    store = response.json().get("data")
-    return [Product(product.get("id"),
-                    product.get("name")) for product in store]
+    With prefetch the next page is requested while the current one is
+    being processed.
+    """
+    for page in iter_page_bodies(path, moltin_client, page_limit, prefetch):
+        yield page.get('data')
 
 
-def get_product_by_id(product_id: str, moltin_client: MoltinClient) -> Product:
-    """Return product serialized dict from moltin"""
-    motlin_access_token = get_motlin_access_token(moltin_client)
-    headers = {
-        'Authorization': f'Bearer {motlin_access_token}',
-    }
+def iter_page_bodies(path: str, moltin_client: MoltinSession,
+                     page_limit: int = 100, prefetch: bool = False,
+                     include: str = None) -> Iterator[dict]:
+    """Yield every page of Moltin list endpoint with included resources"""
 
-    response = requests.get(f'https://api.moltin.com/v2/products/{product_id}',
-                            headers=headers)
-    response.raise_for_status()
-    product = response.json().get("data")
+    def fetch_page(offset: int) -> dict:
+        motlin_access_token = get_motlin_access_token(moltin_client)
+        headers = {
+            'Authorization': f'Bearer {motlin_access_token}',
+        }
+        params = {
+            'page[limit]': page_limit,
+            'page[offset]': offset,
+        }
+        if include:
+            params['include'] = include
+        response = moltin_client.get(path, headers=headers, params=params)
+        response.raise_for_status()
+        return response.json()
+
+    def has_next_page(page: dict) -> bool:
+        return bool(page.get('links', {}).get('next')) and \
+            len(page.get('data')) == page_limit
+
+    offset = 0
+    if not prefetch:
+        while True:
+            page = fetch_page(offset)
+            yield page
+            if not has_next_page(page):
+                return
+            offset += page_limit
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_page = executor.submit(fetch_page, offset)
+        while next_page is not None:
+            page = next_page.result()
+            next_page = None
+            if has_next_page(page):
+                offset += page_limit
+                next_page = executor.submit(fetch_page, offset)
+            yield page
+
+
+def make_product(product: dict) -> Product:
+    """Return Product class from product serialized dict from moltin"""
+    main_image = product.get("relationships", {}).get("main_image", {})
+    price = (product.get('price') or [{}])[0]
     return Product(
         product.get("id"),
         product.get("name"),
         product.get("slug"),
         product.get("description"),
-        product.get("relationships").get("main_image").get("data").get("id"),
-        product.get('price')[0].get('amount'),
-        product.get('price')[0].get('currency')
+        (main_image.get("data") or {}).get("id"),
+        price.get('amount'),
+        price.get('currency'),
+        sku=product.get("sku"),
     )
 
 
+def iter_products(moltin_client: MoltinSession, page_limit: int = 100,
+                  prefetch: bool = False) -> Iterator[Product]:
+    """Yield Product class of every page"""
+    for page in iter_pages('/v2/products', moltin_client, page_limit,
+                           prefetch):
+        for product in page:
+            yield make_product(product)
+
+
+def iter_products_with_image_urls(moltin_client: MoltinSession,
+                                  page_limit: int = 100
+                                  ) -> Iterator[Product]:
+    """Yield products with href of main image instead of its file id"""
+    for page in iter_page_bodies('/v2/products', moltin_client, page_limit,
+                                 include='main_image'):
+        image_urls = {
+            image.get('id'): image.get('link', {}).get('href')
+            for image in page.get('included', {}).get('main_images', [])}
+        for product in page.get('data'):
+            product = make_product(product)
+            yield replace(product,
+                          image_url=image_urls.get(product.image_url))
+
+
+@timed('moltin_call_seconds')
+def get_all_products(moltin_client: MoltinSession) -> [Product]:
+    """Return list if Product class with all products"""
+    return list(iter_products(moltin_client))
+
+
+@timed('moltin_call_seconds')
+def get_product_by_id(product_id: str,
+                      moltin_client: MoltinSession) -> Product:
+    """Return product serialized dict from moltin"""
+    motlin_access_token = get_motlin_access_token(moltin_client)
+    headers = {
+        'Authorization': f'Bearer {motlin_access_token}',
+    }
+
+    response = moltin_client.get(f'/v2/products/{product_id}',
+                                 headers=headers)
+    response.raise_for_status()
+    return make_product(response.json().get("data"))
+
+
+@timed('moltin_call_seconds')
 def get_product_image_by_id(product_file_id: str,
-                            moltin_client: MoltinClient) -> str:
+                            moltin_client: MoltinSession) -> str:
     """Return href product's image from moltin"""
     motlin_access_token = get_motlin_access_token(moltin_client)
 
@@ -124,15 +421,16 @@ def get_product_image_by_id(product_file_id: str,
         'Authorization': f'Bearer {motlin_access_token}',
     }
 
-    response = requests.get(
-        f'https://api.moltin.com/v2/files/{product_file_id}',
+    response = moltin_client.get(
+        f'/v2/files/{product_file_id}',
         headers=headers)
     response.raise_for_status()
     return response.json().get("data").get("link").get("href")
 
 
+@timed('moltin_call_seconds')
 def add_product_in_cart(product_id: str, amount: int, customer_id: int,
-                        moltin_client: MoltinClient) -> None:
+                        moltin_client: MoltinSession) -> None:
     """Add product with his amount in user cart"""
     motlin_access_token = get_motlin_access_token(moltin_client)
     headers = {
@@ -149,14 +447,15 @@ def add_product_in_cart(product_id: str, amount: int, customer_id: int,
         },
     }
 
-    response = requests.post(
-        f'https://api.moltin.com/v2/carts/{customer_id}/items',
+    response = moltin_client.post(
+        f'/v2/carts/{customer_id}/items',
         headers=headers,
         json=json_data)
     response.raise_for_status()
 
 
-def get_cart_items(customer_id, moltin_client: MoltinClient) -> (
+@timed('moltin_call_seconds')
+def get_cart_items(customer_id, moltin_client: MoltinSession) -> (
         [Product], str):
     """Return list if Product class with products in cart and total price"""
     motlin_access_token = get_motlin_access_token(moltin_client)
@@ -164,8 +463,8 @@ def get_cart_items(customer_id, moltin_client: MoltinClient) -> (
         'Authorization': f'Bearer {motlin_access_token}',
     }
 
-    response = requests.get(
-        f'https://api.moltin.com/v2/carts/{customer_id}/items',
+    response = moltin_client.get(
+        f'/v2/carts/{customer_id}/items',
         headers=headers)
     response.raise_for_status()
     cart = response.json()
@@ -183,22 +482,92 @@ def get_cart_items(customer_id, moltin_client: MoltinClient) -> (
     return products, total_price
 
 
+@timed('moltin_call_seconds')
+def add_products_in_cart(amounts: Dict[str, int], customer_id: int,
+                         moltin_client: MoltinSession) -> None:
+    """Add several products with their amounts in user cart at once"""
+    motlin_access_token = get_motlin_access_token(moltin_client)
+    headers = {
+        'Authorization': f'Bearer {motlin_access_token}',
+        'Content-Type': 'application/json',
+        'X-MOLTIN-CURRENCY': 'RUB'
+    }
+
+    json_data = {
+        'data': [
+            {
+                'id': product_id,
+                'type': 'cart_item',
+                'quantity': amount,
+            } for product_id, amount in amounts.items()
+        ],
+    }
+
+    response = moltin_client.post(
+        f'/v2/carts/{customer_id}/items',
+        headers=headers,
+        json=json_data)
+    response.raise_for_status()
+
+
+@timed('moltin_call_seconds')
+def get_cart_quantities(customer_id: int, moltin_client: MoltinSession
+                        ) -> Dict[str, Tuple[str, int]]:
+    """Return cart item id and quantity of every product in user cart"""
+    motlin_access_token = get_motlin_access_token(moltin_client)
+    headers = {
+        'Authorization': f'Bearer {motlin_access_token}',
+    }
+
+    response = moltin_client.get(
+        f'/v2/carts/{customer_id}/items',
+        headers=headers)
+    response.raise_for_status()
+    return {item.get('product_id'): (item.get('id'), item.get('quantity'))
+            for item in response.json().get('data')}
+
+
+@timed('moltin_call_seconds')
+def update_cart_item(item_id: str, amount: int, customer_id: int,
+                     moltin_client: MoltinSession) -> None:
+    """Set amount of product in user cart"""
+    motlin_access_token = get_motlin_access_token(moltin_client)
+    headers = {
+        'Authorization': f'Bearer {motlin_access_token}',
+        'Content-Type': 'application/json',
+    }
+
+    json_data = {
+        'data': {
+            'quantity': amount,
+        },
+    }
+
+    response = moltin_client.put(
+        f'/v2/carts/{customer_id}/items/{item_id}',
+        headers=headers,
+        json=json_data)
+    response.raise_for_status()
+
+
+@timed('moltin_call_seconds')
 def remove_product_from_cart(product_id: str, customer_id: int,
-                             moltin_client: MoltinClient) -> None:
+                             moltin_client: MoltinSession) -> None:
     """Remove product from user cart"""
     motlin_access_token = get_motlin_access_token(moltin_client)
     headers = {
         'Authorization': f'Bearer {motlin_access_token}',
     }
 
-    response = requests.delete(
-        f'https://api.moltin.com/v2/carts/{customer_id}/items/{product_id}',
+    response = moltin_client.delete(
+        f'/v2/carts/{customer_id}/items/{product_id}',
         headers=headers)
     response.raise_for_status()
 
 
+@timed('moltin_call_seconds')
 def create_customer(name: str, email: str,
-                    moltin_client: MoltinClient) -> None:
+                    moltin_client: MoltinSession) -> None:
     """Create customer"""
     motlin_access_token = get_motlin_access_token(moltin_client)
     headers = {
@@ -212,60 +581,96 @@ def create_customer(name: str, email: str,
             'email': email,
         },
     }
-    response = requests.post('https://api.moltin.com/v2/customers',
-                             headers=headers, json=json_data)
+    response = moltin_client.post('/v2/customers',
+                                  headers=headers, json=json_data)
     response.raise_for_status()
 
 
-def get_customer_by_id(customer_id: str, moltin_client: MoltinClient) -> dict:
+def get_customer_by_id(customer_id: str, moltin_client: MoltinSession) -> dict:
     """Get serialize dict with customer by id from motlin"""
     motlin_access_token = get_motlin_access_token(moltin_client)
     headers = {
         'Authorization': f'Bearer {motlin_access_token}',
     }
 
-    response = requests.get(
-        f'https://api.moltin.com/v2/customers/{customer_id}',
+    response = moltin_client.get(
+        f'/v2/customers/{customer_id}',
         headers=headers)
     response.raise_for_status()
     return response.json()
 
 
-def add_product(product: Product, moltin_client: MoltinClient) -> None:
+def make_product_data(product: Product) -> dict:
+    """Return product serialized dict for moltin"""
+    return {
+        'type': 'product',
+        'name': product.name,
+        'slug': product.slug,
+        'sku': product.sku or product.id,
+        'description': product.description,
+        'manage_stock': False,
+        'price': [
+            {
+                'amount': product.price_amount,
+                'currency': product.price_currency,
+                'includes_tax': True,
+            },
+        ],
+        'status': 'live',
+        'commodity_type': 'physical',
+    }
+
+
+def add_product(product: Product, moltin_client: MoltinSession) -> None:
     """Upload product in Moltin"""
     motlin_access_token = get_motlin_access_token(moltin_client)
     headers = {
         'Authorization': f'Bearer {motlin_access_token}',
     }
     json_data = {
-        'data': {
-            'type': 'product',
-            'name': product.name,
-            'slug': product.slug,
-            'sku': product.id,
-            'description': product.description,
-            'manage_stock': False,
-            'price': [
-                {
-                    'amount': product.price_amount,
-                    'currency': product.price_currency,
-                    'includes_tax': True,
-                },
-            ],
-            'status': 'live',
-            'commodity_type': 'physical',
-        },
+        'data': make_product_data(product),
     }
 
-    response = requests.post('https://api.moltin.com/v2/products',
-                             headers=headers, json=json_data)
+    response = moltin_client.post('/v2/products',
+                                  headers=headers, json=json_data)
     response.raise_for_status()
     product_id = response.json().get('data').get('id')
     uploaded_image_id = upload_image(product.image_url, moltin_client)
     add_image_to_product(product_id, uploaded_image_id, moltin_client)
 
 
-def upload_image(image_url: str, moltin_client: MoltinClient) -> str:
+def update_product(product_id: str, product: Product,
+                   moltin_client: MoltinSession) -> None:
+    """Update product fields in Moltin, product image is kept"""
+    motlin_access_token = get_motlin_access_token(moltin_client)
+    headers = {
+        'Authorization': f'Bearer {motlin_access_token}',
+    }
+    json_data = {
+        'data': {
+            'id': product_id,
+            **make_product_data(product),
+        },
+    }
+
+    response = moltin_client.put(f'/v2/products/{product_id}',
+                                 headers=headers, json=json_data)
+    response.raise_for_status()
+
+
+def delete_product(product_id: str, moltin_client: MoltinSession) -> None:
+    """Delete product from Moltin"""
+    motlin_access_token = get_motlin_access_token(moltin_client)
+    headers = {
+        'Authorization': f'Bearer {motlin_access_token}',
+    }
+
+    response = moltin_client.delete(f'/v2/products/{product_id}',
+                                    headers=headers)
+    response.raise_for_status()
+
+
+def upload_image(image_url: str, moltin_client: MoltinSession) -> str:
     """Upload image on Motlin and Return image.id"""
     motlin_access_token = get_motlin_access_token(moltin_client)
     headers = {
@@ -275,15 +680,15 @@ def upload_image(image_url: str, moltin_client: MoltinClient) -> str:
         'file_location': (None, image_url),
     }
 
-    response = requests.post('https://api.moltin.com/v2/files',
-                             headers=headers, files=files)
+    response = moltin_client.post('/v2/files',
+                                  headers=headers, files=files)
     response.raise_for_status()
     image_id = response.json().get('data').get('id')
     return image_id
 
 
 def add_image_to_product(product_id: str, image_id: str,
-                         moltin_client: MoltinClient) -> None:
+                         moltin_client: MoltinSession) -> None:
     """Add uploaded image to Product"""
     motlin_access_token = get_motlin_access_token(moltin_client)
     headers = {
@@ -296,14 +701,14 @@ def add_image_to_product(product_id: str, image_id: str,
         },
     }
 
-    response = requests.post(
-        f'https://api.moltin.com/v2/products/{product_id}/relationships/main-image',
+    response = moltin_client.post(
+        f'/v2/products/{product_id}/relationships/main-image',
         headers=headers, json=json_data)
     response.raise_for_status()
 
 
 def create_flow(name: str, description: str,
-                moltin_client: MoltinClient) -> MoltinFlow:
+                moltin_client: MoltinSession) -> MoltinFlow:
     """Create Flow and Return flow_id, flow_slug"""
     motlin_access_token = get_motlin_access_token(moltin_client)
     headers = {
@@ -320,8 +725,8 @@ def create_flow(name: str, description: str,
         },
     }
 
-    response = requests.post('https://api.moltin.com/v2/flows',
-                             headers=headers, json=json_data)
+    response = moltin_client.post('/v2/flows',
+                                  headers=headers, json=json_data)
     response.raise_for_status()
     flow = response.json()
     flow_id = flow.get('data').get('id')
@@ -329,9 +734,33 @@ def create_flow(name: str, description: str,
     return MoltinFlow(id=flow_id, slug=flow_slug)
 
 
+def get_flow_by_slug(slug: str,
+                     moltin_client: MoltinSession) -> Optional[MoltinFlow]:
+    """Return flow_id, flow_slug of Flow or None if there is no such Flow"""
+    for page in iter_pages('/v2/flows', moltin_client):
+        for flow in page:
+            if flow.get('slug') == slug:
+                return MoltinFlow(id=flow.get('id'), slug=flow.get('slug'))
+    return None
+
+
+def get_flow_field_slugs(flow_slug: str,
+                         moltin_client: MoltinSession) -> List[str]:
+    """Return slugs of all fields of Flow"""
+    motlin_access_token = get_motlin_access_token(moltin_client)
+    headers = {
+        'Authorization': f'Bearer {motlin_access_token}',
+    }
+
+    response = moltin_client.get(f'/v2/flows/{flow_slug}/fields',
+                                 headers=headers)
+    response.raise_for_status()
+    return [field.get('slug') for field in response.json().get('data')]
+
+
 def create_field_in_flow(flow_id: str, field_name: str, description: str,
                          field_type: str, required: bool,
-                         moltin_client: MoltinClient) -> str:
+                         moltin_client: MoltinSession) -> str:
     """Create field in flow and Return field_slug of this flow"""
     motlin_access_token = get_motlin_access_token(moltin_client)
     headers = {
@@ -358,8 +787,8 @@ def create_field_in_flow(flow_id: str, field_name: str, description: str,
         },
     }
 
-    response = requests.post('https://api.moltin.com/v2/fields',
-                             headers=headers, json=json_data)
+    response = moltin_client.post('/v2/fields',
+                                  headers=headers, json=json_data)
     response.raise_for_status()
     return response.json().get('data').get('slug')
 
@@ -369,7 +798,7 @@ def create_an_entry(flow_slug: str,
                     alias_field_slug: str, alias_value: str,
                     lat_field_slug: str, lat_value: str,
                     lon_field_slug: str, lon_value: str,
-                    moltin_client: MoltinClient) -> None:
+                    moltin_client: MoltinSession) -> None:
     """Create Pizza Address entry in fields in Flow-Address"""
     motlin_access_token = get_motlin_access_token(moltin_client)
     headers = {
@@ -386,15 +815,53 @@ def create_an_entry(flow_slug: str,
         }
     }
 
-    response = requests.post(
-        f'https://api.moltin.com/v2/flows/{flow_slug}/entries',
+    response = moltin_client.post(
+        f'/v2/flows/{flow_slug}/entries',
+        headers=headers,
+        json=json_data)
+    response.raise_for_status()
+
+
+def update_entry(flow_slug: str, entry_id: str, fields: dict,
+                 moltin_client: MoltinSession) -> None:
+    """Update fields of entry in Flow"""
+    motlin_access_token = get_motlin_access_token(moltin_client)
+    headers = {
+        'Authorization': f'Bearer {motlin_access_token}',
+    }
+
+    json_data = {
+        'data': {
+            'type': 'entry',
+            'id': entry_id,
+            **fields,
+        }
+    }
+
+    response = moltin_client.put(
+        f'/v2/flows/{flow_slug}/entries/{entry_id}',
         headers=headers,
         json=json_data)
     response.raise_for_status()
 
 
+def delete_entry(flow_slug: str, entry_id: str,
+                 moltin_client: MoltinSession) -> None:
+    """Delete entry from Flow"""
+    motlin_access_token = get_motlin_access_token(moltin_client)
+    headers = {
+        'Authorization': f'Bearer {motlin_access_token}',
+    }
+
+    response = moltin_client.delete(
+        f'/v2/flows/{flow_slug}/entries/{entry_id}',
+        headers=headers)
+    response.raise_for_status()
+
+
+@timed('moltin_call_seconds')
 def create_customer_address(user: int, lat: float, lon: float, flow_slug: str,
-                            moltin_client: MoltinClient) -> None:
+                            moltin_client: MoltinSession) -> None:
     """Create User-customer Address entry in fields in Flow-Customer"""
     motlin_access_token = get_motlin_access_token(moltin_client)
     headers = {
@@ -410,41 +877,41 @@ def create_customer_address(user: int, lat: float, lon: float, flow_slug: str,
         }
     }
 
-    response = requests.post(
-        f'https://api.moltin.com/v2/flows/{flow_slug}/entries',
+    response = moltin_client.post(
+        f'/v2/flows/{flow_slug}/entries',
         headers=headers,
         json=json_data)
     response.raise_for_status()
     return response.json().get('data').get('id')
 
 
-def get_all_address_entries(slug: str, moltin_client: MoltinClient) -> List[
-    PizzaAddress]:
-    """Return all Pizza Address"""
-    motlin_access_token = get_motlin_access_token(moltin_client)
-    headers = {
-        'Authorization': f'Bearer {motlin_access_token}',
-    }
+def iter_address_entries(slug: str, moltin_client: MoltinSession,
+                         page_limit: int = 100,
+                         prefetch: bool = False) -> Iterator[PizzaAddress]:
+    """Yield Pizza Address of every page"""
+    for page in iter_pages(f'/v2/flows/{slug}/entries', moltin_client,
+                           page_limit, prefetch):
+        for address in page:
+            yield from_dict(data_class=PizzaAddress, data=address)
 
-    response = requests.get(f'https://api.moltin.com/v2/flows/{slug}/entries',
-                            headers=headers)
-    response.raise_for_status()
 
-    addresses = response.json().get('data')
-    return [from_dict(data_class=PizzaAddress, data=address) for address in
-            addresses]
+@timed('moltin_call_seconds')
+def get_all_address_entries(slug: str, moltin_client: MoltinSession) -> List[
+    PizzaAddress]:
+    """Return all Pizza Address"""
+    return list(iter_address_entries(slug, moltin_client))
 
 
 def get_address_by_id(slug: str, address_id: str,
-                      moltin_client: MoltinClient) -> PizzaAddress:
+                      moltin_client: MoltinSession) -> PizzaAddress:
     """Return PizzaAddress class by address_id"""
     motlin_access_token = get_motlin_access_token(moltin_client)
     headers = {
         'Authorization': f'Bearer {motlin_access_token}',
     }
 
-    response = requests.get(
-        f'https://api.moltin.com/v2/flows/{slug}/entries/{address_id}',
+    response = moltin_client.get(
+        f'/v2/flows/{slug}/entries/{address_id}',
         headers=headers)
     response.raise_for_status()
 
@@ -1,14 +1,20 @@
+import argparse
 import json
 import logging
 from dataclasses import dataclass
 from pathlib import Path
+from typing import Iterator, List, Optional
 
 from environs import Env
-from requests.exceptions import HTTPError
 from slugify import slugify
 
 from moltin_tools import add_product, Product, create_flow, \
-    create_field_in_flow, PizzaAddress, create_an_entry, MoltinClient
+    create_field_in_flow, PizzaAddress, create_an_entry, MoltinSession, \
+    iter_products_with_image_urls, update_product, delete_product, \
+    iter_address_entries, update_entry, delete_entry, get_flow_by_slug, \
+    get_flow_field_slugs, upload_image, add_image_to_product
+from sync_tools import SyncAction, SyncResult, plan_sync, apply_sync, \
+    print_sync_plan, get_product_hash, get_address_hash
 
 BASE_DIR = Path(__file__).resolve(strict=True).parent
 logger = logging.getLogger(__name__)
@@ -22,62 +28,202 @@ class FlowFields:
     lon_field: str
 
 
-def parse_menu(path_to_menu: str, moltin_client: MoltinClient):
-    with open(path_to_menu, "r", encoding='utf-8') as menu_file:
-        menu_json = menu_file.read()
+def iter_json_records(path: str, chunk_size: int = 64 * 1024) -> Iterator:
+    """Yield elements of JSON array or lines of JSON Lines file.
 
-    menu = json.loads(menu_json)
-    for dish in menu:
-        product = Product(
+    File is read by chunks, so only the current element is kept in memory.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, "r", encoding='utf-8') as records_file:
+        buffer = ''
+        chunk = records_file.read(chunk_size)
+        while chunk and not buffer:
+            buffer = chunk.lstrip()
+            chunk = records_file.read(chunk_size)
+        buffer += chunk
+        if not buffer.startswith('['):
+            records_file.seek(0)
+            for line in records_file:
+                if line.strip():
+                    yield json.loads(line)
+            return
+
+        position = 1
+        is_eof = False
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            if position < len(buffer) and buffer[position] == ']':
+                return
+            try:
+                record, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if is_eof:
+                    raise
+                record, end = None, None
+            # element is complete only if it is followed by , or ]
+            delimiter = end
+            while delimiter is not None and delimiter < len(buffer) and \
+                    buffer[delimiter] in ' \t\r\n':
+                delimiter += 1
+            if end is None or delimiter == len(buffer) or \
+                    buffer[delimiter] not in ',]':
+                # only a number cut by chunk border may continue after it
+                if is_eof or end is not None and delimiter < len(buffer) \
+                        and buffer[delimiter] not in '.eE+-0123456789':
+                    raise json.JSONDecodeError("Expecting ',' delimiter",
+                                               buffer, delimiter)
+                chunk = records_file.read(chunk_size)
+                is_eof = not chunk
+                buffer = buffer[position:] + chunk
+                position = 0
+                continue
+            yield record
+            position = end
+
+
+def iter_menu(path_to_menu: str) -> Iterator[Product]:
+    for dish in iter_json_records(path_to_menu):
+        yield Product(
             name=dish.get("name"),
             slug=slugify(dish.get("name")),
             id=str(dish.get("id")),
+            sku=str(dish.get("id")),
             description=dish.get("description"),
             image_url=dish.get("product_image").get("url"),
             price_amount=dish.get("price"),
             price_currency='RUB' if dish.get(
                 "culture_name") == 'ru-RU' else "USD"
         )
-        try:
-            add_product(product, moltin_client)
-        except HTTPError as error:
-            logger.info(
-                f"Product: {product.id} - {product.name}. An error occurred while loading product\n{error}")
-        else:
-            logger.info(
-                f"Product: {product.id} - {product.name} uploaded successfully")
 
 
-def parse_addresses(path_to_addresses: str, flow_fields: FlowFields,
-                    flow_slug: str, moltin_client: MoltinClient):
-    with open(path_to_addresses, "r", encoding='utf-8') as addresses_file:
-        addresses_json = addresses_file.read()
-
-    addresses = json.loads(addresses_json)
-    for address in addresses:
-        pizza_address = PizzaAddress(
+def iter_addresses(path_to_addresses: str) -> Iterator[PizzaAddress]:
+    for address in iter_json_records(path_to_addresses):
+        yield PizzaAddress(
             address=address.get("address").get("full"),
             alias=address.get("alias"),
             lat=address.get("coordinates").get("lat"),
             lon=address.get("coordinates").get("lon"),
         )
-        try:
-            create_an_entry(
-                flow_slug,
-                flow_fields.address_field, pizza_address.address,
-                flow_fields.alias_field, pizza_address.alias,
-                flow_fields.lat_field, pizza_address.lat,
-                flow_fields.lon_field, pizza_address.lon,
-                moltin_client)
-        except HTTPError as error:
-            logger.info(
-                f"Address: {pizza_address.address}. An error occurred while loading address\n{error}")
-        else:
-            logger.info(
-                f"Address: {pizza_address.address} uploaded successfully")
+
+
+def parse_menu(path_to_menu: str, moltin_client: MoltinSession,
+               workers: int = 1, dry_run: bool = False) -> List[SyncResult]:
+    sync_actions = plan_sync(
+        iter_menu(path_to_menu),
+        iter_products_with_image_urls(moltin_client),
+        get_key=lambda product: product.sku,
+        get_hash=get_product_hash,
+    )
+    if dry_run:
+        print_sync_plan("Menu", sync_actions)
+        return []
+
+    def update_menu_product(sync_action: SyncAction):
+        product = sync_action.item
+        update_product(sync_action.remote_id, product, moltin_client)
+        # Image changed in menu or its upload failed when it was created
+        if product.image_url and \
+                product.image_url != sync_action.remote_item.image_url:
+            image_id = upload_image(product.image_url, moltin_client)
+            add_image_to_product(sync_action.remote_id, image_id,
+                                 moltin_client)
+
+    handlers = {
+        'create': lambda sync_action: add_product(sync_action.item,
+                                                  moltin_client),
+        'update': update_menu_product,
+        'delete': lambda sync_action: delete_product(
+            sync_action.remote_id, moltin_client),
+    }
+    return apply_sync(sync_actions, handlers, workers)
+
+
+def parse_addresses(path_to_addresses: str, flow_fields: FlowFields,
+                    flow_slug: str, moltin_client: MoltinSession,
+                    workers: int = 1,
+                    dry_run: bool = False) -> List[SyncResult]:
+    remote_addresses = iter_address_entries(flow_slug, moltin_client) \
+        if flow_slug else []
+    sync_actions = plan_sync(
+        iter_addresses(path_to_addresses),
+        remote_addresses,
+        get_key=lambda address: address.alias,
+        get_hash=get_address_hash,
+    )
+    if dry_run:
+        print_sync_plan("Addresses", sync_actions)
+        return []
+
+    def create_address(sync_action: SyncAction):
+        pizza_address = sync_action.item
+        create_an_entry(
+            flow_slug,
+            flow_fields.address_field, pizza_address.address,
+            flow_fields.alias_field, pizza_address.alias,
+            flow_fields.lat_field, pizza_address.lat,
+            flow_fields.lon_field, pizza_address.lon,
+            moltin_client)
+
+    def update_address(sync_action: SyncAction):
+        pizza_address = sync_action.item
+        fields = {
+            flow_fields.address_field: pizza_address.address,
+            flow_fields.alias_field: pizza_address.alias,
+            flow_fields.lat_field: pizza_address.lat,
+            flow_fields.lon_field: pizza_address.lon,
+        }
+        update_entry(flow_slug, sync_action.remote_id, fields, moltin_client)
+
+    handlers = {
+        'create': create_address,
+        'update': update_address,
+        'delete': lambda sync_action: delete_entry(
+            flow_slug, sync_action.remote_id, moltin_client),
+    }
+    return apply_sync(sync_actions, handlers, workers)
+
+
+def get_address_flow(moltin_client: MoltinSession, dry_run: bool = False) -> (
+        Optional[str], Optional[FlowFields]):
+    """Return slug and fields of address Flow, create missing ones"""
+    flow_name = 'Pizza Address'
+    flow_description = 'Адрес пиццерии'
+    flow = get_flow_by_slug(slugify(flow_name), moltin_client)
+    if flow is None:
+        if dry_run:
+            print(f"Flow:\ncreate {slugify(flow_name)}")
+            return None, None
+        flow = create_flow(flow_name, flow_description, moltin_client)
+
+    flow_field_slugs = get_flow_field_slugs(flow.slug, moltin_client)
+    fields = [
+        ('address', flow_description),
+        ('alias', 'Алиас пиццерии'),
+        ('lat', 'Широта пиццерии'),
+        ('lon', 'Долгота пиццерии'),
+    ]
+    field_slugs = []
+    for field_name, description in fields:
+        field_slug = slugify(field_name)
+        if field_slug not in flow_field_slugs:
+            if dry_run:
+                print(f"Flow field:\ncreate {field_slug}")
+            else:
+                field_slug = create_field_in_flow(flow.id, field_name,
+                                                  description, 'string',
+                                                  True, moltin_client)
+        field_slugs.append(field_slug)
+    return flow.slug, FlowFields(*field_slugs)
 
 
 def main():
+    parser = argparse.ArgumentParser(
+        description='Sync menu and pizzerias addresses with Moltin')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='print planned changes without applying them')
+    args = parser.parse_args()
+
     logging.basicConfig(
         format='%(asctime)s : %(message)s',
         datefmt='%d/%m/%Y %H:%M:%S',
@@ -85,38 +231,31 @@ def main():
     )
     env = Env()
     env.read_env()
-    moltin_client = MoltinClient(
+    import_workers = env.int("IMPORT_WORKERS", 4)
+    moltin_client = MoltinSession(
         client_id=env("MOTLIN_CLIENT_ID"),
-        client_secret=env("MOTLIN_CLIENT_SECRET")
+        client_secret=env("MOTLIN_CLIENT_SECRET"),
+        base_url=env("MOTLIN_API_URL", "https://api.moltin.com"),
+        pool_size=max(env.int("MOTLIN_POOL_SIZE", 10), import_workers),
+        timeout=env.float("MOTLIN_TIMEOUT", 10),
+        retries=env.int("MOTLIN_RETRIES", 3),
+        rate_limit=env.float("MOTLIN_RATE_LIMIT", 20),
+        failure_threshold=env.int("MOTLIN_FAILURE_THRESHOLD", 5),
+        reset_timeout=env.float("MOTLIN_RESET_TIMEOUT", 30),
+        retry_rate_limited=True,
+        retry_timeouts=True
     )
     menu_filename = env("MENU_FILENAME")
     addresses_filename = env("ADDRESSES_FILENAME")
 
     path_to_menu = BASE_DIR / menu_filename
     path_to_addresses = BASE_DIR / addresses_filename
-    flow_name = 'Pizza Address'
-    flow_description = 'Адрес пиццерии'
 
-    parse_menu(path_to_menu, moltin_client)
-
-    flow_id, flow_slug = create_flow(flow_name, flow_description,
-                                     moltin_client)
-    address_field = create_field_in_flow(flow_id, 'address', flow_description,
-                                      'string', True, moltin_client)
-    alias_field = create_field_in_flow(flow_id, 'alias', 'Алиас пиццерии',
-                                       'string', True, moltin_client)
-    lat_field = create_field_in_flow(flow_id, 'lat', 'Широта пиццерии',
-                                     'string', True, moltin_client)
-    lon_field = create_field_in_flow(flow_id, 'lon', 'Долгота пиццерии',
-                                     'string', True, moltin_client)
-
-    flow_fields = FlowFields(
-        address_field=address_field,
-        alias_field=alias_field,
-        lat_field=lat_field,
-        lon_field=lon_field
-    )
-    parse_addresses(path_to_addresses, flow_fields, flow_slug, moltin_client)
+    parse_menu(path_to_menu, moltin_client, import_workers, args.dry_run)
+
+    flow_slug, flow_fields = get_address_flow(moltin_client, args.dry_run)
+    parse_addresses(path_to_addresses, flow_fields, flow_slug, moltin_client,
+                    import_workers, args.dry_run)
 
 
 if __name__ == "__main__":
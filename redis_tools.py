@@ -0,0 +1,143 @@
+import atexit
+import json
+import logging
+import threading
+import time
+from typing import Optional, Tuple
+
+import redis
+
+from metrics_tools import measure
+
+logger = logging.getLogger(__name__)
+
+STATE_FIELD = 's'
+USER_DATA_FIELDS = {
+    'total_price': 'tp',
+    'address': 'a',
+    'deliveryman_tg': 'dt',
+    'user_lat': 'la',
+    'user_lon': 'lo',
+}
+
+
+def make_redis_pool(host: str, port: int, password: str = None,
+                    max_connections: int = 64,
+                    timeout: float = 5) -> redis.BlockingConnectionPool:
+    """Return pool which waits for a free connection instead of failing"""
+    return redis.BlockingConnectionPool(
+        host=host,
+        port=port,
+        password=password,
+        max_connections=max_connections,
+        timeout=timeout,
+        socket_timeout=timeout,
+        socket_connect_timeout=timeout,
+        health_check_interval=30
+    )
+
+
+class ChatStore:
+    """Conversation state and user_data of chats in Redis hashes.
+
+    Every chat is one hash with short field names, its TTL is renewed on
+    every save. If write_behind_interval is set, saved chats are kept in
+    process and written to Redis in one pipeline every interval, so they
+    must not be handled by other processes meanwhile.
+    """
+
+    def __init__(self, redis_db: redis.client.Redis,
+                 ttl: int = 30 * 24 * 3600, key_prefix: str = 'chat',
+                 write_behind_interval: float = 0):
+        self.redis_db = redis_db
+        self.ttl = ttl
+        self.key_prefix = key_prefix
+        self.write_behind_interval = write_behind_interval
+        self.user_data_keys = {
+            field: key for key, field in USER_DATA_FIELDS.items()}
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        if write_behind_interval:
+            threading.Thread(target=self._flush_periodically,
+                             daemon=True).start()
+            atexit.register(self.flush)
+
+    def get_key(self, chat_id: int) -> str:
+        return f'{self.key_prefix}:{chat_id}'
+
+    def load(self, chat_id: int) -> Tuple[Optional[str], dict]:
+        """Return state and user_data of chat"""
+        with self._pending_lock:
+            pending_chat = self._pending.get(chat_id)
+        if pending_chat is not None:
+            state, user_data = pending_chat
+            return state, dict(user_data)
+        with measure('chat_store_seconds', operation='load'):
+            chat = self.redis_db.hgetall(self.get_key(chat_id))
+        state = chat.pop(STATE_FIELD.encode('utf-8'), None)
+        if state is not None:
+            state = state.decode('utf-8')
+        user_data = {
+            self.user_data_keys[field.decode('utf-8')]: json.loads(value)
+            for field, value in chat.items()
+            if field.decode('utf-8') in self.user_data_keys}
+        return state, user_data
+
+    def save(self, chat_id: int, state: str, user_data: dict) -> None:
+        """Replace state and user_data of chat in one round trip"""
+        if self.write_behind_interval:
+            with self._pending_lock:
+                self._pending[chat_id] = (state, dict(user_data))
+            return
+        pipeline = self.redis_db.pipeline()
+        self._add_chat(pipeline, chat_id, state, user_data)
+        with measure('chat_store_seconds', operation='save'):
+            pipeline.execute()
+
+    def flush(self) -> None:
+        """Write chats saved in process to Redis in one pipeline"""
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        pipeline = self.redis_db.pipeline(transaction=False)
+        for chat_id, (state, user_data) in list(pending.items()):
+            try:
+                self._add_chat(pipeline, chat_id, state, user_data)
+            except (TypeError, ValueError) as error:
+                # Requeued, it would fail the whole batch on every flush
+                logger.error(f'Chat {chat_id} was not saved: {error}')
+                del pending[chat_id]
+        try:
+            with measure('chat_store_seconds', operation='flush'):
+                pipeline.execute()
+        except redis.RedisError:
+            with self._pending_lock:
+                self._pending = {**pending, **self._pending}
+            raise
+
+    def _add_chat(self, pipeline: redis.client.Pipeline, chat_id: int,
+                  state: str, user_data: dict) -> None:
+        chat = self._encode_chat(state, user_data)
+        key = self.get_key(chat_id)
+        pipeline.delete(key)
+        pipeline.hset(key, mapping=chat)
+        pipeline.expire(key, self.ttl)
+
+    @staticmethod
+    def _encode_chat(state: str, user_data: dict) -> dict:
+        if not isinstance(state, str):
+            raise TypeError(f'State must be a string, not {state!r}')
+        chat = {STATE_FIELD: state}
+        chat.update({
+            field: json.dumps(user_data[key], ensure_ascii=False)
+            for key, field in USER_DATA_FIELDS.items() if key in user_data})
+        return chat
+
+    def _flush_periodically(self) -> None:
+        while True:
+            time.sleep(self.write_behind_interval)
+            try:
+                self.flush()
+            except redis.RedisError as error:
+                logger.error(f'Chats were not written to Redis: {error}')
@@ -0,0 +1,154 @@
+import threading
+import time
+
+import requests
+
+
+class UpstreamUnavailableError(requests.RequestException):
+    """Request was not sent because the upstream is failing or overloaded"""
+
+
+class CircuitOpenError(UpstreamUnavailableError):
+    pass
+
+
+class RateLimitedError(UpstreamUnavailableError):
+    pass
+
+
+class CircuitBreaker:
+    """Stop calling an upstream after several failures in a row.
+
+    After reset_timeout one call is let through, the circuit closes if it
+    succeeds and stays open for another reset_timeout if it fails.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5,
+                 reset_timeout: float = 30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def before_call(self) -> None:
+        """Raise CircuitOpenError if the upstream must not be called"""
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if self._probing or \
+                    time.monotonic() - self._opened_at < self.reset_timeout:
+                raise CircuitOpenError(f'{self.name} is unavailable')
+            self._probing = True
+
+    def release(self) -> None:
+        """Let another call through if this one was not made"""
+        with self._lock:
+            self._probing = False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._probing = False
+
+
+class RateLimiter:
+    """Token bucket which slows down when the upstream answers 429.
+
+    The rate is halved on every 429 and calls wait for Retry-After, then
+    it grows back by a small step on every successful call. A call which
+    would wait longer than max_wait fails at once.
+    """
+
+    def __init__(self, name: str, rate: float = 20, max_wait: float = 5,
+                 min_rate: float = 1):
+        self.name = name
+        self.max_rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.rate = rate
+        self.max_wait = max_wait
+        self._tokens = rate
+        self._updated_at = time.monotonic()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Wait for a free slot or raise RateLimitedError"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.rate, self._tokens +
+                               (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            wait = max(self._paused_until - now,
+                       (1 - self._tokens) / self.rate, 0)
+            if wait > self.max_wait:
+                raise RateLimitedError(f'{self.name} rate limit is reached')
+            self._tokens -= 1
+        if wait:
+            time.sleep(wait)
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 100)
+
+    def record_rate_limited(self, retry_after: float) -> None:
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._paused_until = max(self._paused_until,
+                                     time.monotonic() + retry_after)
+
+
+def get_retry_after(response: requests.Response,
+                    default: float = 1) -> float:
+    """Return seconds from Retry-After header of the response"""
+    try:
+        return float(response.headers.get('Retry-After', default))
+    except ValueError:
+        return default
+
+
+def send_guarded_request(session: requests.Session, method: str, url: str,
+                         circuit_breaker: CircuitBreaker,
+                         rate_limiter: RateLimiter,
+                         **kwargs) -> requests.Response:
+    """Send request unless the upstream is failing or overloaded.
+
+    Connection errors, timeouts, 5xx and 429 answers count as failures of
+    the upstream.
+    """
+    circuit_breaker.before_call()
+    try:
+        rate_limiter.acquire()
+        response = session.request(method, url, **kwargs)
+    except RateLimitedError:
+        circuit_breaker.release()
+        raise
+    except requests.RequestException:
+        circuit_breaker.record_failure()
+        raise
+    except BaseException:
+        circuit_breaker.release()
+        raise
+    if response.status_code == 429:
+        rate_limiter.record_rate_limited(get_retry_after(response))
+        circuit_breaker.record_failure()
+    elif response.status_code >= 500:
+        circuit_breaker.record_failure()
+    else:
+        rate_limiter.record_success()
+        circuit_breaker.record_success()
+    return response
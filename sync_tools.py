@@ -0,0 +1,126 @@
+import hashlib
+import json
+import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterable, Iterator, List, \
+    NamedTuple, Optional
+
+from requests.exceptions import RequestException
+
+from moltin_tools import Product, PizzaAddress
+
+logger = logging.getLogger(__name__)
+
+
+class SyncAction(NamedTuple):
+    action: str
+    key: str
+    item: Any
+    remote_id: Optional[str] = None
+    remote_item: Any = None
+
+
+class SyncResult(NamedTuple):
+    action: str
+    key: str
+    error: Optional[str] = None
+
+
+def get_content_hash(*values) -> str:
+    """Return hash of values as they are stored in Moltin"""
+    content = json.dumps([None if value is None else str(value)
+                          for value in values], ensure_ascii=False)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def get_product_hash(product: Product) -> str:
+    return get_content_hash(product.name, product.slug, product.description,
+                            product.price_amount, product.price_currency,
+                            product.image_url)
+
+
+def get_address_hash(address: PizzaAddress) -> str:
+    return get_content_hash(address.address, address.lat, address.lon)
+
+
+def plan_sync(local_items: Iterable, remote_items: Iterable,
+              get_key: Callable[[Any], str],
+              get_hash: Callable[[Any], str]) -> Iterator[SyncAction]:
+    """Yield actions which make remote items the same as local ones.
+
+    Items are matched by key and compared by content hash. Local items are
+    consumed one by one, only their keys are kept to find deleted ones.
+    Remote items without key were not created by sync and are left
+    untouched. Nothing is deleted if there are no local items at all, as
+    it is rather a broken source than an empty catalog.
+    """
+    remote_items = {get_key(item): (get_hash(item), item)
+                    for item in remote_items if get_key(item)}
+    local_keys = set()
+    for item in local_items:
+        key = get_key(item)
+        local_keys.add(key)
+        if key not in remote_items:
+            yield SyncAction('create', key, item)
+            continue
+        remote_hash, remote_item = remote_items[key]
+        if get_hash(item) != remote_hash:
+            yield SyncAction('update', key, item, remote_item.id,
+                             remote_item)
+    if not local_keys:
+        if remote_items:
+            logger.error(f'Source is empty, {len(remote_items)} items '
+                         f'are not deleted')
+        return
+    for key, (_, remote_item) in remote_items.items():
+        if key not in local_keys:
+            yield SyncAction('delete', key, None, remote_item.id,
+                             remote_item)
+
+
+def print_sync_plan(title: str, sync_actions: Iterable[SyncAction]) -> None:
+    print(f'{title}:')
+    has_actions = False
+    for sync_action in sync_actions:
+        print(f'{sync_action.action} {sync_action.key}')
+        has_actions = True
+    if not has_actions:
+        print('Nothing to sync')
+
+
+def apply_sync(sync_actions: Iterable[SyncAction],
+               handlers: Dict[str, Callable[[SyncAction], None]],
+               workers: int = 1) -> List[SyncResult]:
+    """Run handler of every action in thread pool and log the results.
+
+    Actions are taken from iterable only when a worker is about to be
+    free, so they can be produced while previous ones are applied.
+    """
+
+    def apply_action(sync_action: SyncAction) -> SyncResult:
+        try:
+            handlers[sync_action.action](sync_action)
+        except RequestException as error:
+            logger.info(f"{sync_action.action} {sync_action.key}. "
+                        f"An error occurred while syncing\n{error}")
+            return SyncResult(sync_action.action, sync_action.key,
+                              str(error))
+        logger.info(f"{sync_action.action} {sync_action.key} "
+                    f"synced successfully")
+        return SyncResult(sync_action.action, sync_action.key)
+
+    sync_results = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for sync_action in sync_actions:
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                sync_results.extend(future.result() for future in done)
+            pending.add(executor.submit(apply_action, sync_action))
+        done, _ = wait(pending)
+        sync_results.extend(future.result() for future in done)
+
+    failed_results = [result for result in sync_results if result.error]
+    logger.info(f"Synced: {len(sync_results) - len(failed_results)}, "
+                f"failed: {len(failed_results)}")
+    return sync_results
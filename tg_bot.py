@@ -1,39 +1,66 @@
+import json
 import logging
+import threading
 from functools import partial
 from textwrap import dedent
 
 import redis
 from environs import Env
 from notifiers.logging import NotificationHandler
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, \
-    LabeledPrice
+from requests.exceptions import RequestException
+from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup, \
+    Update, LabeledPrice, Message
+from telegram.error import BadRequest
 from telegram.ext import CallbackQueryHandler, CommandHandler, \
-    MessageHandler, Updater, Filters, CallbackContext, PreCheckoutQueryHandler
+    MessageHandler, Updater, Filters, CallbackContext, \
+    PreCheckoutQueryHandler, Dispatcher
+from telegram.utils.request import Request
 
+from cache_tools import CatalogCache, ProductCache, PhotoCache, \
+    AddressRegistry, GeocodeCache
+from cart_tools import CartMirror
 from format_message import create_cart_message, create_product_description
-from geo_tools import fetch_coordinates, get_min_dist
-from moltin_tools import get_all_products, get_product_by_id, \
-    get_product_image_by_id, add_product_in_cart, get_cart_items, \
-    remove_product_from_cart, create_customer, get_all_address_entries, \
-    create_customer_address, MoltinClient
+from geo_tools import GEOCODER_URL, get_min_dist
+from http_tools import start_http_server
+from job_tools import RedisJobQueue
+from metrics_tools import TimedBot, TimedRedis, handle_metrics_request, \
+    measure, metrics
+from moltin_tools import create_customer, create_customer_address, \
+    MoltinSession, Product
+from redis_tools import ChatStore, make_redis_pool
+from webhook_tools import run_update_router, run_update_workers
 
 logger = logging.getLogger(__name__)
+menu_markups = {}
+chat_locks = [threading.Lock() for _ in range(1024)]
 
 
-def send_notification(context):
+def send_notification(bot: Bot, chat_id: int):
     text = f"Приятного аппетита! *место для рекламы*\n\n" \
            f"*сообщение что делать если пицца не пришла*"
-    context.bot.send_message(chat_id=context.job.context, text=text)
+    bot.send_message(chat_id=chat_id, text=text)
 
 
-def create_menu_buttons(moltin_client: MoltinClient):
-    products = get_all_products(moltin_client)
+def refresh_product_cache(context: CallbackContext):
+    try:
+        context.bot_data['product_cache'].refresh()
+    except Exception as err:
+        logger.error(f'Product cache was not refreshed: {err}')
+
+
+def create_menu_buttons(catalog_cache: CatalogCache):
+    version, products = catalog_cache.get_versioned_products()
+    reply_markup = menu_markups.get(version)
+    if reply_markup is not None:
+        return reply_markup
     keyboard = [
         [InlineKeyboardButton(product.name, callback_data=product.id)]
         for product in products]
     keyboard.append(
         [InlineKeyboardButton('Корзина', callback_data='cart')])
     reply_markup = InlineKeyboardMarkup(keyboard)
+    menu_markups.clear()
+    menu_markups[version] = reply_markup
     return reply_markup
 
 
@@ -57,20 +84,83 @@ def create_address_keyboard():
     return keyboard
 
 
+def send_product_photo(context: CallbackContext, product: Product,
+                       **kwargs) -> Message:
+    """Send product photo by cached Telegram file_id or by image url"""
+    photo_cache = context.bot_data['photo_cache']
+    file_id = photo_cache.get(product.id)
+    if file_id:
+        try:
+            return context.bot.send_photo(photo=file_id, **kwargs)
+        except BadRequest as err:
+            logger.warning(f'Product {product.id} photo is lost: {err}')
+            photo_cache.delete(product.id)
+
+    image_url = context.bot_data['product_cache'].get_image_url(
+        product.image_url)
+    message = context.bot.send_photo(photo=image_url, **kwargs)
+    photo_cache.set(product.id, message.photo[-1].file_id)
+    return message
+
+
+def refresh_address_registry(context: CallbackContext):
+    try:
+        context.bot_data['address_registry'].refresh()
+    except Exception as err:
+        logger.error(f'Pizza addresses were not refreshed: {err}')
+
+
+def handle_moltin_webhook(body: bytes, headers, bot_data: dict,
+                          webhook_secret: str):
+    """Refresh cached catalog or addresses after they changed in Moltin"""
+    if headers.get('X-Moltin-Secret-Key') != webhook_secret:
+        return 403, 'Forbidden'
+    event = json.loads(body or b'{}')
+    if event.get('triggered_by', '').startswith('product'):
+        bot_data['catalog_cache'].invalidate()
+        # Prices of carts and invoices are taken from cached products
+        bot_data['product_cache'].invalidate()
+        bot_data['photo_cache'].clear()
+    else:
+        bot_data['address_registry'].refresh()
+    return 200, 'OK'
+
+
+def warm_up_photos(update: Update, context: CallbackContext):
+    """Upload every catalog photo to Telegram to cache its file_id"""
+    photo_cache = context.bot_data['photo_cache']
+    product_cache = context.bot_data['product_cache']
+    uploaded_photos = 0
+    for catalog_product in context.bot_data['catalog_cache'].get_products():
+        if photo_cache.get(catalog_product.id):
+            continue
+        product = product_cache.get_product(catalog_product.id)
+        message = send_product_photo(context, product,
+                                     chat_id=update.effective_chat.id,
+                                     disable_notification=True)
+        context.bot.delete_message(chat_id=message.chat_id,
+                                   message_id=message.message_id)
+        uploaded_photos += 1
+    update.message.reply_text(f'Загружено фото: {uploaded_photos}')
+
+
 def start(update: Update, context: CallbackContext, payment_token: str,
-          moltin_client: MoltinClient, ya_geo_api_token: str):
-    reply_markup = create_menu_buttons(moltin_client)
+          moltin_client: MoltinSession, ya_geo_api_token: str):
+    reply_markup = create_menu_buttons(context.bot_data['catalog_cache'])
 
-    update.message.reply_text('Please choose:', reply_markup=reply_markup)
+    # Chat without stored state starts here from a button tap as well
+    context.bot.send_message(text='Please choose:',
+                             reply_markup=reply_markup,
+                             chat_id=update.effective_chat.id)
     return "HANDLE_MENU"
 
 
 def handle_menu(update: Update, context: CallbackContext, payment_token: str,
-                moltin_client: MoltinClient, ya_geo_api_token: str):
+                moltin_client: MoltinSession, ya_geo_api_token: str):
     query = update.callback_query
     if query.data == 'cart':
-        products, total_price = get_cart_items(update.effective_user.id,
-                                               moltin_client)
+        products, total_price = context.bot_data['cart_mirror'].get_items(
+            update.effective_user.id)
         context.user_data['total_price'] = total_price
         message = create_cart_message(products, total_price)
         reply_markup = create_card_buttons(products)
@@ -78,7 +168,7 @@ def handle_menu(update: Update, context: CallbackContext, payment_token: str,
                                  reply_markup=reply_markup,
                                  chat_id=query.message.chat_id)
         return "HANDLE_CART"
-    product = get_product_by_id(query.data, moltin_client)
+    product = context.bot_data['product_cache'].get_product(query.data)
     keyboard = [
         [InlineKeyboardButton("Добавить в корзину",
                               callback_data=f"1,{product.id}"), ],
@@ -87,9 +177,10 @@ def handle_menu(update: Update, context: CallbackContext, payment_token: str,
     ]
 
     reply_markup = InlineKeyboardMarkup(keyboard)
-    context.bot.send_photo(
+    send_product_photo(
+        context,
+        product,
         chat_id=query.message.chat_id,
-        photo=get_product_image_by_id(product.image_url, moltin_client),
         caption=create_product_description(product),
         reply_markup=reply_markup
     )
@@ -99,10 +190,10 @@ def handle_menu(update: Update, context: CallbackContext, payment_token: str,
 
 
 def handle_cart(update: Update, context: CallbackContext, payment_token: str,
-                moltin_client: MoltinClient, ya_geo_api_token: str):
+                moltin_client: MoltinSession, ya_geo_api_token: str):
     query = update.callback_query
     if query.data == 'menu':
-        reply_markup = create_menu_buttons(moltin_client)
+        reply_markup = create_menu_buttons(context.bot_data['catalog_cache'])
 
         context.bot.send_message(text='Please choose:',
                                  reply_markup=reply_markup,
@@ -120,10 +211,10 @@ def handle_cart(update: Update, context: CallbackContext, payment_token: str,
             chat_id=query.message.chat_id)
         return "HANDLE_WAITING_ADDRESS"
     else:
-        remove_product_from_cart(query.data, update.effective_user.id,
-                                 moltin_client)
-        products, total_price = get_cart_items(update.effective_user.id,
-                                               moltin_client)
+        context.bot_data['cart_mirror'].remove(update.effective_user.id,
+                                               query.data)
+        products, total_price = context.bot_data['cart_mirror'].get_items(
+            update.effective_user.id)
         context.user_data['total_price'] = total_price
         message = create_cart_message(products, total_price)
         reply_markup = create_card_buttons(products)
@@ -134,7 +225,7 @@ def handle_cart(update: Update, context: CallbackContext, payment_token: str,
 
 
 def handle_description(update: Update, context: CallbackContext,
-                       payment_token: str, moltin_client: MoltinClient,
+                       payment_token: str, moltin_client: MoltinSession,
                        ya_geo_api_token: str):
     query = update.callback_query
     try:
@@ -144,7 +235,7 @@ def handle_description(update: Update, context: CallbackContext,
         product_id = None
 
     if command == 'back':
-        reply_markup = create_menu_buttons(moltin_client)
+        reply_markup = create_menu_buttons(context.bot_data['catalog_cache'])
 
         context.bot.send_message(text='Please choose:',
                                  reply_markup=reply_markup,
@@ -154,8 +245,8 @@ def handle_description(update: Update, context: CallbackContext,
         return "HANDLE_MENU"
 
     if command == 'cart':
-        products, total_price = get_cart_items(update.effective_user.id,
-                                               moltin_client)
+        products, total_price = context.bot_data['cart_mirror'].get_items(
+            update.effective_user.id)
         context.user_data['total_price'] = total_price
         message = create_cart_message(products, total_price)
         reply_markup = create_card_buttons(products)
@@ -164,26 +255,16 @@ def handle_description(update: Update, context: CallbackContext,
                                  chat_id=query.message.chat_id)
         return "HANDLE_CART"
 
-    if command == '1':
-        update.callback_query.answer("Товар добавлен в корзину")
-        add_product_in_cart(product_id, 1, update.effective_user.id,
-                            moltin_client)
-        return "HANDLE_DESCRIPTION"
-    if command == '3':
-        update.callback_query.answer("Товар добавлен в корзину")
-        add_product_in_cart(product_id, 3, update.effective_user.id,
-                            moltin_client)
-        return "HANDLE_DESCRIPTION"
-    if command == '5':
+    if command in ('1', '3', '5'):
         update.callback_query.answer("Товар добавлен в корзину")
-        add_product_in_cart(product_id, 5, update.effective_user.id,
-                            moltin_client)
+        context.bot_data['cart_mirror'].add(update.effective_user.id,
+                                            product_id, int(command))
         return "HANDLE_DESCRIPTION"
     return "HANDLE_MENU"
 
 
 def handle_waiting_email(update: Update, context: CallbackContext,
-                         payment_token: str, moltin_client: MoltinClient,
+                         payment_token: str, moltin_client: MoltinSession,
                          ya_geo_api_token: str):
     user = update.effective_user
     name = f"{user.first_name}_tgid-{user.id}"
@@ -195,12 +276,13 @@ def handle_waiting_email(update: Update, context: CallbackContext,
 
 
 def handle_waiting_address(update: Update, context: CallbackContext,
-                           payment_token: str, moltin_client: MoltinClient,
+                           payment_token: str, moltin_client: MoltinSession,
                            ya_geo_api_token: str):
     query = update.callback_query
     if query:
         if query.data == 'menu':
-            reply_markup = create_menu_buttons(moltin_client)
+            reply_markup = create_menu_buttons(
+                context.bot_data['catalog_cache'])
 
             context.bot.send_message(text='Please choose:',
                                      reply_markup=reply_markup,
@@ -221,7 +303,8 @@ def handle_waiting_address(update: Update, context: CallbackContext,
     if message.location:
         current_pos = (message.location.latitude, message.location.longitude)
     else:
-        current_pos = fetch_coordinates(ya_geo_api_token, message.text)
+        current_pos = context.bot_data['geocode_cache'].fetch_coordinates(
+            ya_geo_api_token, message.text)
         if not current_pos:
             keyboard = create_address_keyboard()
             reply_markup = InlineKeyboardMarkup(keyboard)
@@ -231,8 +314,8 @@ def handle_waiting_address(update: Update, context: CallbackContext,
                 chat_id=update.message.chat_id)
             return "HANDLE_WAITING_ADDRESS"
 
-    addresses = get_all_address_entries('pizza-address', moltin_client)
-    nearest_address, dist_to_nearest_address = get_min_dist(addresses,
+    address_index = context.bot_data['address_registry'].get_index()
+    nearest_address, dist_to_nearest_address = get_min_dist(address_index,
                                                             current_pos)
 
     if dist_to_nearest_address <= 500:
@@ -294,11 +377,11 @@ def handle_waiting_address(update: Update, context: CallbackContext,
 
 
 def handle_delivery(update: Update, context: CallbackContext,
-                    payment_token: str, moltin_client: MoltinClient,
+                    payment_token: str, moltin_client: MoltinSession,
                     ya_geo_api_token: str):
     query = update.callback_query
     if query.data == 'menu':
-        reply_markup = create_menu_buttons(moltin_client)
+        reply_markup = create_menu_buttons(context.bot_data['catalog_cache'])
 
         context.bot.send_message(text='Please choose:',
                                  reply_markup=reply_markup,
@@ -316,23 +399,26 @@ def handle_delivery(update: Update, context: CallbackContext,
         user_lat = context.user_data['user_lat']
         user_lon = context.user_data['user_lon']
         user = update.effective_user
-        create_customer_address(
+        products, total_price = context.bot_data['cart_mirror'].get_items(
+            user.id)
+        context.user_data['total_price'] = total_price
+        background_jobs = context.bot_data['background_jobs']
+        # Moltin cart gets the ordered products even if a sync failed
+        background_jobs.enqueue('sync_cart', customer_id=user.id)
+        background_jobs.enqueue(
+            'create_customer_address',
             user=user.id,
             lat=user_lat,
             lon=user_lon,
-            flow_slug='customer-address',
-            moltin_client=moltin_client,
+            flow_slug='customer-address'
+        )
+        background_jobs.enqueue(
+            'notify_deliveryman',
+            deliveryman_tg=deliveryman_tg,
+            message=create_cart_message(products, total_price),
+            lat=user_lat,
+            lon=user_lon
         )
-        products, total_price = get_cart_items(update.effective_user.id,
-                                               moltin_client)
-        context.user_data['total_price'] = total_price
-        message = create_cart_message(products, total_price)
-
-        context.bot.send_message(text=message,
-                                 chat_id=deliveryman_tg)
-        context.bot.send_location(chat_id=deliveryman_tg,
-                                  latitude=user_lat,
-                                  longitude=user_lon)
         context.bot.send_message(text=f"Оплатите ваш заказ",
                                  chat_id=query.message.chat_id)
 
@@ -357,6 +443,12 @@ def handle_delivery(update: Update, context: CallbackContext,
         return "HANDLE_MENU"
 
 
+def notify_deliveryman(bot: Bot, deliveryman_tg: int, message: str,
+                       lat: float, lon: float):
+    bot.send_message(text=message, chat_id=deliveryman_tg)
+    bot.send_location(chat_id=deliveryman_tg, latitude=lat, longitude=lon)
+
+
 def precheckout_callback(update, context):
     query = update.pre_checkout_query
     if query.invoice_payload != 'Payload':
@@ -375,13 +467,13 @@ def precheckout_callback(update, context):
 def successful_payment_callback(update, context):
     update.message.reply_text("Thank you for your payment!")
     update.message.reply_text("Ваш заказ создан")
-    context.job_queue.run_once(send_notification, 3600,
-                               context=update.effective_user.id)
+    context.bot_data['background_jobs'].enqueue_in(
+        3600, 'send_notification', chat_id=update.effective_user.id)
 
 
 def handle_users_reply(update: Update, context: CallbackContext,
-                       redis_db: redis.client.Redis,
-                       payment_token: str, moltin_client: MoltinClient,
+                       chat_store: ChatStore,
+                       payment_token: str, moltin_client: MoltinSession,
                        ya_geo_api_token: str):
     if update.message:
         user_reply = update.message.text
@@ -391,10 +483,22 @@ def handle_users_reply(update: Update, context: CallbackContext,
         chat_id = update.callback_query.message.chat_id
     else:
         return
-    if user_reply == '/start':
+    # Handlers run concurrently, so updates of one chat are serialized
+    with chat_locks[chat_id % len(chat_locks)]:
+        handle_chat_reply(update, context, chat_id, user_reply, chat_store,
+                          payment_token, moltin_client, ya_geo_api_token)
+
+
+def handle_chat_reply(update: Update, context: CallbackContext, chat_id: int,
+                      user_reply: str, chat_store: ChatStore,
+                      payment_token: str, moltin_client: MoltinSession,
+                      ya_geo_api_token: str):
+    # Chat may be handled by another worker before, so its data is reloaded
+    user_state, user_data = chat_store.load(chat_id)
+    context.user_data.clear()
+    context.user_data.update(user_data)
+    if user_reply == '/start' or user_state is None:
         user_state = 'START'
-    else:
-        user_state = redis_db.get(str(chat_id)).decode("utf-8")
 
     states_functions = {
         'START': start,
@@ -407,9 +511,18 @@ def handle_users_reply(update: Update, context: CallbackContext,
     }
     state_handler = states_functions[user_state]
     try:
-        next_state = state_handler(update, context, payment_token,
-                                   moltin_client, ya_geo_api_token)
-        redis_db.set(str(chat_id), next_state)
+        with measure('state_handler_seconds', state=user_state):
+            next_state = state_handler(update, context, payment_token,
+                                       moltin_client, ya_geo_api_token)
+        # Handler returns None if it ignored the update
+        if next_state is not None:
+            chat_store.save(chat_id, next_state, context.user_data)
+    except RequestException as err:
+        # Moltin or Yandex is down, the user stays in the same state
+        logging.warning(err)
+        context.bot.send_message(
+            text='Сервис временно недоступен, попробуйте через минуту',
+            chat_id=chat_id)
     except Exception as err:
         logging.error(err)
 
@@ -419,6 +532,89 @@ def handle_error(update: Update, context: CallbackContext):
     logger.exception(context.error)
 
 
+def make_bot_data(env: Env, redis_database: redis.client.Redis,
+                  moltin_client: MoltinSession) -> dict:
+    """Return services shared by handlers, configured from env"""
+    catalog_cache = CatalogCache(
+        moltin_client,
+        ttl=env.int("CATALOG_CACHE_TTL", 300),
+        redis_db=redis_database if env.bool("CATALOG_CACHE_SHARED", False)
+        else None
+    )
+    product_cache = ProductCache(
+        moltin_client,
+        catalog_cache,
+        maxsize=env.int("PRODUCT_CACHE_SIZE", 256),
+        ttl=env.int("PRODUCT_CACHE_TTL", 3600)
+    )
+    return {
+        'catalog_cache': catalog_cache,
+        'product_cache': product_cache,
+        'cart_mirror': CartMirror(
+            redis_database,
+            moltin_client,
+            product_cache,
+            sync_delay=env.float("CART_SYNC_DELAY", 2)
+        ),
+        'photo_cache': PhotoCache(redis_database),
+        'geocode_cache': GeocodeCache(
+            redis_database,
+            ttl=env.int("GEOCODE_CACHE_TTL", 30 * 24 * 3600),
+            negative_ttl=env.int("GEOCODE_CACHE_NEGATIVE_TTL", 24 * 3600),
+            geocoder_url=env("YANDEX_GEOCODER_URL", GEOCODER_URL),
+            timeout=env.float("YANDEX_TIMEOUT", 5),
+            rate_limit=env.float("YANDEX_RATE_LIMIT", 10),
+            failure_threshold=env.int("YANDEX_FAILURE_THRESHOLD", 5),
+            reset_timeout=env.float("YANDEX_RESET_TIMEOUT", 30)
+        ),
+        'address_registry': AddressRegistry(moltin_client, 'pizza-address'),
+        'background_jobs': RedisJobQueue(
+            redis_database,
+            max_attempts=env.int("JOB_MAX_ATTEMPTS", 5),
+            retry_delay=env.float("JOB_RETRY_DELAY", 10)
+        ),
+    }
+
+
+def add_handlers(dispatcher: Dispatcher, chat_store: ChatStore,
+                 payment_token: str, moltin_client: MoltinSession,
+                 ya_geo_api_token: str, admin_chat_id: int,
+                 run_async: bool = True):
+    handle_users_reply_with_args = partial(
+        handle_users_reply,
+        chat_store=chat_store,
+        payment_token=payment_token,
+        moltin_client=moltin_client,
+        ya_geo_api_token=ya_geo_api_token
+    )
+    dispatcher.add_handler(
+        CommandHandler('start', handle_users_reply_with_args,
+                       run_async=run_async))
+    dispatcher.add_handler(
+        CommandHandler('warmup', warm_up_photos,
+                       filters=Filters.chat(admin_chat_id),
+                       run_async=run_async))
+
+    dispatcher.add_handler(
+        CallbackQueryHandler(handle_users_reply_with_args,
+                             run_async=run_async))
+    dispatcher.add_handler(
+        MessageHandler(Filters.text, handle_users_reply_with_args,
+                       run_async=run_async))
+    dispatcher.add_error_handler(handle_error)
+    handle_waiting_address_with_args = partial(
+        handle_waiting_address,
+        ya_geo_api_token=ya_geo_api_token
+    )
+    location_handler = MessageHandler(Filters.location | Filters.text,
+                                      handle_waiting_address_with_args)
+    dispatcher.add_handler(location_handler)
+    dispatcher.add_handler(PreCheckoutQueryHandler(precheckout_callback))
+
+    dispatcher.add_handler(MessageHandler(Filters.successful_payment,
+                                          successful_payment_callback))
+
+
 def main():
     logging.basicConfig(
         format='%(asctime)s : %(message)s',
@@ -429,14 +625,25 @@ def main():
     env.read_env()
     telegram_api_token = env("TELEGRAM_API_TOKEN")
     telegram_chat_id = env("TELEGRAM_CHAT_ID")
-    redis_database = redis.Redis(
+    redis_database = TimedRedis(connection_pool=make_redis_pool(
         host=env("DATABASE_HOST"),
         port=env("DATABASE_PORT"),
-        password=env("DATABASE_PASSWORD")
-    )
-    moltin_client = MoltinClient(
+        password=env("DATABASE_PASSWORD"),
+        max_connections=env.int("REDIS_POOL_SIZE", 64),
+        timeout=env.float("REDIS_TIMEOUT", 5)
+    ))
+    moltin_client = MoltinSession(
         client_id=env("MOTLIN_CLIENT_ID"),
-        client_secret=env("MOTLIN_CLIENT_SECRET")
+        client_secret=env("MOTLIN_CLIENT_SECRET"),
+        base_url=env("MOTLIN_API_URL", "https://api.moltin.com"),
+        pool_size=env.int("MOTLIN_POOL_SIZE", 10),
+        timeout=env.float("MOTLIN_TIMEOUT", 10),
+        retries=env.int("MOTLIN_RETRIES", 3),
+        rate_limit=env.float("MOTLIN_RATE_LIMIT", 20),
+        failure_threshold=env.int("MOTLIN_FAILURE_THRESHOLD", 5),
+        reset_timeout=env.float("MOTLIN_RESET_TIMEOUT", 30),
+        redis_db=redis_database if env.bool("MOTLIN_TOKEN_SHARED", False)
+        else None
     )
     yandex_geo_api_token = env("YANDEX_GEO_API_TOKEN")
     tg_merchant_token = env.str("TG_MERCHANT_TOKEN")
@@ -448,36 +655,102 @@ def main():
     tg_handler = NotificationHandler("telegram", defaults=params)
     logger.addHandler(tg_handler)
 
-    updater = Updater(telegram_api_token)
+    bot_mode = env("BOT_MODE", "polling")
+    webhook_shards = env.int("WEBHOOK_SHARDS", 16)
+    bot_workers = env.int("BOT_WORKERS", 32)
+    bot = TimedBot(telegram_api_token,
+                   base_url=env("TELEGRAM_API_URL", None),
+                   request=Request(con_pool_size=bot_workers + 4))
+    updater = Updater(bot=bot, workers=bot_workers)
+    metrics.log_observations = env.bool("METRICS_LOG", False)
+    metrics.add_gauge('moltin_deduplicated_requests',
+                      lambda: moltin_client.single_flight.deduplicated)
+    metrics_port = env.int("METRICS_PORT", None)
+    if metrics_port:
+        start_http_server(metrics_port, {
+            ('GET', '/metrics'): handle_metrics_request,
+        })
+    if bot_mode == 'router':
+        run_update_router(
+            updater.bot,
+            redis_database,
+            port=env.int("WEBHOOK_PORT", 8443),
+            webhook_url=env("WEBHOOK_URL"),
+            shards=webhook_shards,
+            secret_token=env("WEBHOOK_SECRET_TOKEN", None)
+        )
+        return
+
+    moltin_client.token_manager.start_refreshing()
     dispatcher = updater.dispatcher
-    handle_users_reply_with_args = partial(
-        handle_users_reply,
-        redis_db=redis_database,
-        payment_token=tg_merchant_token,
-        moltin_client=moltin_client,
-        ya_geo_api_token=yandex_geo_api_token
+    dispatcher.bot_data.update(
+        make_bot_data(env, redis_database, moltin_client))
+    geocode_cache = dispatcher.bot_data['geocode_cache']
+    metrics.add_gauge('geocode_cache_hits', lambda: geocode_cache.hits)
+    metrics.add_gauge('geocode_cache_misses', lambda: geocode_cache.misses)
+    updater.job_queue.run_repeating(
+        refresh_address_registry,
+        interval=env.int("ADDRESS_REFRESH_INTERVAL", 3600),
+        first=0
     )
-    dispatcher.add_handler(
-        CommandHandler('start', handle_users_reply_with_args))
-
-    dispatcher.add_handler(CallbackQueryHandler(handle_users_reply_with_args))
-    dispatcher.add_handler(
-        MessageHandler(Filters.text, handle_users_reply_with_args))
-    dispatcher.add_error_handler(handle_error)
-    handle_waiting_address_with_args = partial(
-        handle_waiting_address,
-        ya_geo_api_token=yandex_geo_api_token
+    background_jobs = dispatcher.bot_data['background_jobs']
+    job_handlers = {
+        'sync_cart': dispatcher.bot_data['cart_mirror'].sync,
+        'create_customer_address': partial(create_customer_address,
+                                           moltin_client=moltin_client),
+        'notify_deliveryman': partial(notify_deliveryman, updater.bot),
+        'send_notification': partial(send_notification, updater.bot),
+    }
+    job_worker_threads = env.int("JOB_WORKER_THREADS", 4)
+    if bot_mode == 'jobs':
+        background_jobs.run_workers(
+            job_handlers,
+            worker_id=env("JOB_WORKER_ID", "0"),
+            threads=job_worker_threads
+        )
+        return
+    worker_shards = env.list("WORKER_SHARDS",
+                             list(range(webhook_shards)), subcast=int)
+    if env.bool("RUN_JOBS", True):
+        # Default id is stable after restarts and differs between processes
+        default_worker_id = 'polling' if bot_mode != 'worker' else \
+            'worker:' + ','.join(map(str, worker_shards))
+        background_jobs.start_workers(
+            job_handlers,
+            worker_id=env("JOB_WORKER_ID", default_worker_id),
+            threads=job_worker_threads
+        )
+    webhook_port = env.int("MOTLIN_WEBHOOK_PORT", None)
+    if webhook_port:
+        handle_moltin_webhook_with_args = partial(
+            handle_moltin_webhook,
+            bot_data=dispatcher.bot_data,
+            webhook_secret=env("MOTLIN_WEBHOOK_SECRET")
+        )
+        start_http_server(webhook_port, {
+            ('POST', '/moltin'): handle_moltin_webhook_with_args,
+        })
+    updater.job_queue.run_repeating(
+        refresh_product_cache,
+        interval=env.int("PRODUCT_CACHE_REFRESH_INTERVAL", 600),
+        first=0
     )
-    location_handler = MessageHandler(Filters.location | Filters.text,
-                                      handle_waiting_address_with_args)
-    dispatcher.add_handler(location_handler)
-    dispatcher.add_handler(PreCheckoutQueryHandler(precheckout_callback))
-
-    dispatcher.add_handler(MessageHandler(Filters.successful_payment,
-                                          successful_payment_callback))
-
-    updater.start_polling()
-    updater.idle()
+    chat_store = ChatStore(
+        redis_database,
+        ttl=env.int("CHAT_DATA_TTL", 30 * 24 * 3600),
+        write_behind_interval=env.float("CHAT_WRITE_BEHIND_INTERVAL", 0)
+    )
+    # Worker keeps order of chat updates by handling each shard in turn
+    add_handlers(dispatcher, chat_store, tg_merchant_token, moltin_client,
+                 yandex_geo_api_token, int(telegram_chat_id),
+                 run_async=bot_mode != 'worker')
+
+    if bot_mode == 'worker':
+        updater.job_queue.start()
+        run_update_workers(dispatcher, redis_database, worker_shards)
+    else:
+        updater.start_polling()
+        updater.idle()
 
 
 if __name__ == '__main__':
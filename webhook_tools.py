@@ -0,0 +1,101 @@
+import json
+import logging
+import threading
+import time
+from functools import partial
+from typing import List
+
+import redis
+from telegram import Bot, Update
+from telegram.ext import Dispatcher
+
+from http_tools import start_http_server
+
+logger = logging.getLogger(__name__)
+
+
+def get_update_chat_id(update: dict) -> int:
+    """Return id of chat the raw Telegram update belongs to"""
+    for update_type in ('message', 'edited_message'):
+        if update_type in update:
+            return update[update_type]['chat']['id']
+    if 'callback_query' in update:
+        return update['callback_query']['message']['chat']['id']
+    if 'pre_checkout_query' in update:
+        return update['pre_checkout_query']['from']['id']
+    return 0
+
+
+def get_shard_queue(shard: int, queue_prefix: str = 'updates') -> str:
+    return f'{queue_prefix}:{shard}'
+
+
+def route_update(body: bytes, headers, redis_db: redis.client.Redis,
+                 shards: int, secret_token: str = None):
+    """Put Telegram update into the queue of its chat's shard.
+
+    Updates of one chat always get into one queue and are handled by one
+    worker thread in the order they came.
+    """
+    if secret_token and \
+            headers.get('X-Telegram-Bot-Api-Secret-Token') != secret_token:
+        return 403, 'Forbidden'
+    chat_id = get_update_chat_id(json.loads(body))
+    redis_db.rpush(get_shard_queue(chat_id % shards), body)
+    return 200, 'OK'
+
+
+def run_update_router(bot: Bot, redis_db: redis.client.Redis, port: int,
+                      webhook_url: str, shards: int,
+                      secret_token: str = None) -> None:
+    """Receive Telegram webhooks and spread updates among shard queues"""
+
+    route_update_with_args = partial(
+        route_update,
+        redis_db=redis_db,
+        shards=shards,
+        secret_token=secret_token
+    )
+    start_http_server(port, {
+        ('POST', '/telegram'): route_update_with_args,
+    })
+    bot.set_webhook(url=f'{webhook_url.rstrip("/")}/telegram',
+                    secret_token=secret_token)
+    logger.info(f'Routing updates to {shards} shards')
+    threading.Event().wait()
+
+
+def consume_updates(dispatcher: Dispatcher, redis_db: redis.client.Redis,
+                    queue: str) -> None:
+    """Handle updates of one shard queue one by one"""
+    while True:
+        try:
+            queued_update = redis_db.blpop(queue, timeout=1)
+        except redis.RedisError as error:
+            logger.error(f'Updates were not taken from {queue}: {error}')
+            time.sleep(1)
+            continue
+        if queued_update is None:
+            continue
+        _, update_json = queued_update
+        try:
+            update = Update.de_json(json.loads(update_json), dispatcher.bot)
+        except (ValueError, TypeError, KeyError) as error:
+            logger.error(f'Bad update in {queue} is dropped: {error}')
+            continue
+        dispatcher.process_update(update)
+
+
+def run_update_workers(dispatcher: Dispatcher, redis_db: redis.client.Redis,
+                       shards: List[int]) -> None:
+    """Handle updates of given shards, one thread per shard"""
+    threads = [
+        threading.Thread(target=consume_updates,
+                         args=(dispatcher, redis_db, get_shard_queue(shard)),
+                         daemon=True)
+        for shard in shards]
+    for thread in threads:
+        thread.start()
+    logger.info(f'Handling updates of shards {shards}')
+    for thread in threads:
+        thread.join()